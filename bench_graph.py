@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""图谱接口性能测试：通过 /graph 接口比较整体序列化与流式输出的峰值内存和耗时
+
+默认需要本地运行的Neo4j（配置同 config.env）；--memory 使用内存中的模拟图谱，
+只测量接口本身的序列化和分块输出开销。用法：
+    python bench_graph.py [边数量，默认100000] [--memory]
+"""
+import resource
+import sys
+import time
+import tracemalloc
+
+from fastapi.testclient import TestClient
+
+from main import app, graph_builder, storage_router
+
+BENCH_USER = "bench_user"
+neo4j_driver = storage_router.driver_for(BENCH_USER)
+
+class MemoryRelation:
+    type = "HAS_SYMPTOM"
+
+class MemorySession:
+    """按 _iter_graph_nodes / _iter_graph_edges 的查询返回模拟记录"""
+
+    def __init__(self, edge_count: int):
+        self.edge_count = edge_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def run(self, query: str, **kwargs):
+        user = {"user_id": BENCH_USER}
+        if "RETURN node_id" in query:
+            yield {"node_id": BENCH_USER, "is_user": True, "name": None, "type": None, "confidence": 0.0}
+            for i in range(self.edge_count):
+                yield {"node_id": f"bench_{i}_症状", "is_user": False, "name": f"bench_{i}", "type": "症状", "confidence": 0.9}
+        else:
+            for i in range(self.edge_count):
+                yield {"a": user, "r": MemoryRelation, "b": {"name": f"bench_{i}", "type": "症状"}}
+
+class MemoryDriver:
+    def __init__(self, edge_count: int):
+        self.edge_count = edge_count
+
+    def session(self):
+        return MemorySession(self.edge_count)
+
+def seed_graph(edge_count: int):
+    """写入测试图谱：1个用户节点，edge_count 个实体节点和用户关系"""
+    with neo4j_driver.session() as session:
+        session.run("MERGE (u:User {user_id: $user_id})", user_id=BENCH_USER)
+        batch_size = 10000
+        for offset in range(0, edge_count, batch_size):
+            session.run("""
+                UNWIND range($start, $end - 1) AS i
+                MERGE (e:Entity {name: 'bench_' + toString(i), type: '症状'})
+                SET e.confidence = 0.9
+                WITH e
+                MATCH (u:User {user_id: $user_id})
+                MERGE (u)-[:HAS_SYMPTOM]->(e)
+            """, start=offset, end=min(offset + batch_size, edge_count), user_id=BENCH_USER)
+
+def cleanup_graph():
+    with neo4j_driver.session() as session:
+        session.run("MATCH (e:Entity) WHERE e.name STARTS WITH 'bench_' DETACH DELETE e")
+        session.run("MATCH (u:User {user_id: $user_id}) DETACH DELETE u", user_id=BENCH_USER)
+
+def measure(name: str, func):
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = func()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{name}: 耗时 {elapsed:.2f}s, Python峰值分配 {peak / 1024 / 1024:.1f}MB, "
+          f"进程峰值RSS {max_rss:.1f}MB, 输出 {size / 1024 / 1024:.1f}MB")
+
+def full_response() -> int:
+    response = client.get(f"/graph/{BENCH_USER}")
+    assert response.status_code == 200
+    return len(response.content)
+
+def streamed_response() -> int:
+    """StreamingResponse 在线程池中迭代生成器，分块经ASGI逐块发送"""
+    size = 0
+    with client.stream("GET", f"/graph/{BENCH_USER}", params={"stream": "true"}) as response:
+        assert response.status_code == 200
+        for chunk in response.iter_raw():
+            size += len(chunk)
+    return size
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    edge_count = int(args[0]) if args else 100000
+    in_memory = "--memory" in sys.argv
+
+    if in_memory:
+        storage_router.shard_for(BENCH_USER).driver = MemoryDriver(edge_count)
+    elif not neo4j_driver:
+        print("Neo4j未连接，无法进行性能测试（可使用 --memory）")
+        sys.exit(1)
+    else:
+        print(f"写入测试图谱（{edge_count} 条关系）...")
+        seed_graph(edge_count)
+
+    client = TestClient(app)
+    try:
+        # 先测流式输出，进程峰值RSS只增不减
+        measure(f"流式输出（每批 {graph_builder.STREAM_BATCH_ITEMS} 条）", streamed_response)
+        batch_items = graph_builder.STREAM_BATCH_ITEMS
+        graph_builder.STREAM_BATCH_ITEMS = 1
+        measure("流式输出（每条一块）", streamed_response)
+        graph_builder.STREAM_BATCH_ITEMS = batch_items
+        measure("整体序列化", full_response)
+    finally:
+        if not in_memory:
+            cleanup_graph()
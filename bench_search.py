@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""全文检索性能测试：用随机生成的对话构建索引并测量内存占用和查询延迟
+
+不需要数据库。用法：
+    python bench_search.py [会话数量，默认1000000] [用户数量，默认10000]
+"""
+import random
+import resource
+import statistics
+import sys
+import time
+
+from main import SearchIndex
+
+VOCABULARY = [
+    "头痛", "发热", "咳嗽", "胃痛", "失眠", "乏力", "恶心", "腹泻", "胸闷", "头晕",
+    "感冒", "高血压", "糖尿病", "胃炎", "支气管炎", "偏头痛", "过敏", "贫血",
+    "布洛芬", "阿司匹林", "奥美拉唑", "二甲双胍", "氨氯地平", "阿莫西林",
+    "血常规", "心电图", "胃镜", "血糖", "医生", "患者", "最近", "三天", "一周", "好转"
+]
+QUERIES = ["头痛", "高血压 氨氯地平", "胃痛 奥美拉唑 胃镜", "最近 失眠", "糖尿病 血糖 二甲双胍"]
+
+def random_conversation(rng: random.Random) -> str:
+    return "，".join(rng.choice(VOCABULARY) for _ in range(rng.randint(20, 60)))
+
+def measure_queries(index: SearchIndex, rng: random.Random, user_count: int, per_user: bool, rounds: int = 50):
+    latencies = []
+    for _ in range(rounds):
+        query = rng.choice(QUERIES)
+        user_id = f"user_{rng.randrange(user_count)}" if per_user else None
+        started = time.perf_counter()
+        index.search(query, user_id=user_id, limit=20)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+if __name__ == "__main__":
+    doc_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    user_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    rng = random.Random(42)
+
+    index = SearchIndex()
+    started = time.perf_counter()
+    for i in range(doc_count):
+        index.index_document(f"SESS_{i}", f"user_{i % user_count}", random_conversation(rng))
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"构建索引：{doc_count} 个会话，耗时 {time.perf_counter() - started:.1f}s，词项 {len(index.terms)} 个，"
+          f"进程峰值RSS {max_rss:.0f}MB")
+
+    p50, p95 = measure_queries(index, rng, user_count, per_user=False)
+    print(f"全局检索：p50 {p50:.1f}ms, p95 {p95:.1f}ms")
+    p50, p95 = measure_queries(index, rng, user_count, per_user=True)
+    print(f"按用户检索：p50 {p50:.2f}ms, p95 {p95:.2f}ms")
@@ -1,21 +1,44 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import uuid
 import json
-from datetime import datetime
+import asyncio
+import base64
+import math
+import heapq
+import re
+import time
+import bisect
+import hashlib
+import io
+import gzip
+import zlib
+import tempfile
+import random
+import contextvars
+import threading
+import orjson
+import gridfs
+import numpy as np
+from scipy import sparse
+from array import array
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 import httpx
-from bson import ObjectId
+from bson import ObjectId, json_util
 from neo4j import GraphDatabase
+from neo4j.time import DateTime as Neo4jDateTime
 
 # 加载环境变量
 load_dotenv("config.env")
 
-app = FastAPI(title="个人健康知识图谱系统 - 第一阶段")
+app = FastAPI(title="个人健康知识图谱系统 - 第一阶段", default_response_class=ORJSONResponse)
 
 # MongoDB连接
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
@@ -26,34 +49,362 @@ NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
 NEO4J_USERNAME = os.getenv("NEO4J_USERNAME", "neo4j")
 NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "password")
 
-try:
-    client = MongoClient(MONGODB_URL)
-    db = client[MONGODB_DATABASE]
-    # 测试连接
-    client.admin.command('ping')
-    print("MongoDB连接成功")
-except Exception as e:
-    print(f"MongoDB连接失败: {e}")
-    db = None
+# 存储分片配置（JSON数组，每项包含 name/mongodb_url/mongodb_database/neo4j_uri/neo4j_username/neo4j_password），
+# 未配置时只有一个使用上面连接参数的默认分片
+STORAGE_SHARDS = os.getenv("STORAGE_SHARDS")
+# 用户分片目录缓存时间（秒），迁移用户时会等待该时间让各进程刷新缓存
+SHARD_DIRECTORY_TTL = int(os.getenv("SHARD_DIRECTORY_TTL", "30"))
 
-# Neo4j连接
-try:
-    neo4j_driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USERNAME, NEO4J_PASSWORD))
-    # 测试连接
-    with neo4j_driver.session() as session:
-        session.run("RETURN 1")
-    print("Neo4j连接成功")
-except Exception as e:
-    print(f"Neo4j连接失败: {e}")
-    neo4j_driver = None
+class StorageShard:
+    """一个存储分片：一个MongoDB数据库和一个Neo4j实例"""
+
+    def __init__(self, name: str, db, driver):
+        self.name = name
+        self.db = db
+        self.driver = driver
+
+def connect_storage_shard(config: dict) -> StorageShard:
+    name = config.get("name", "default")
+
+    try:
+        client = MongoClient(config.get("mongodb_url", MONGODB_URL))
+        shard_db = client[config.get("mongodb_database", MONGODB_DATABASE)]
+        # 测试连接
+        client.admin.command('ping')
+        # 会话查询和批量重新提取所需索引
+        shard_db.conversations.create_index("session_id")
+        shard_db.conversations.create_index("user_id")
+        shard_db.extractions.create_index("session_id")
+        shard_db.extractions.create_index("prompt_version")
+        # 健康时间线按 (user_id, 时间桶) 范围查询并按时间倒序排序（索引方向与排序一致才能免去内存排序）
+        shard_db.health_events.create_index([("user_id", 1), ("bucket", -1), ("occurred_at", -1), ("_id", -1)])
+        shard_db.health_events.create_index("session_id")
+        # 预生成的健康档案按版本保存，同一用户的档案版本唯一
+        shard_db.health_profiles.create_index([("user_id", 1), ("version", -1)], unique=True)
+        shard_db.profile_state.create_index("user_id", unique=True)
+        # 共现分析结果按实体名称查询
+        shard_db.analytics_related.create_index("name")
+        shard_db.analytics_user_entities.create_index("user_id", unique=True)
+        print(f"MongoDB连接成功（分片 {name}）")
+    except Exception as e:
+        print(f"MongoDB连接失败（分片 {name}）: {e}")
+        shard_db = None
+
+    try:
+        driver = GraphDatabase.driver(
+            config.get("neo4j_uri", NEO4J_URI),
+            auth=(config.get("neo4j_username", NEO4J_USERNAME), config.get("neo4j_password", NEO4J_PASSWORD))
+        )
+        # 测试连接
+        with driver.session() as session:
+            session.run("RETURN 1")
+        print(f"Neo4j连接成功（分片 {name}）")
+    except Exception as e:
+        print(f"Neo4j连接失败（分片 {name}）: {e}")
+        driver = None
+
+    return StorageShard(name, shard_db, driver)
+
+# 存储分片路由
+class ShardRouter:
+    """按 user_id 路由到存储分片
+
+    新用户按一致性哈希环分配分片，分配结果记录在第一个分片的 user_shards 集合中；
+    已分配的用户始终按目录路由，因此增加分片后只有显式迁移的用户会移动。
+    """
+    VIRTUAL_NODES = 64
+
+    def __init__(self, shards: list, directory_ttl: int = SHARD_DIRECTORY_TTL):
+        self.shards = {shard.name: shard for shard in shards}
+        self.default = shards[0]
+        self.directory_ttl = directory_ttl
+        self.directory_cache = {}   # user_id -> (分片名, 缓存时间)
+        self.ring = sorted(
+            (self._hash(f"{shard.name}#{index}"), shard.name)
+            for shard in shards
+            for index in range(self.VIRTUAL_NODES)
+        )
+        self.ring_keys = [key for key, _ in self.ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:16], 16)
+
+    @property
+    def directory(self):
+        return self.default.db.user_shards if self.default.db is not None else None
+
+    def ring_shard(self, user_id: str) -> StorageShard:
+        """一致性哈希环上该用户对应的分片"""
+        index = bisect.bisect(self.ring_keys, self._hash(user_id)) % len(self.ring)
+        return self.shards[self.ring[index][1]]
+
+    def shard_for(self, user_id: str) -> StorageShard:
+        if len(self.shards) == 1:
+            return self.default
+
+        cached = self.directory_cache.get(user_id)
+        if cached and time.monotonic() - cached[1] < self.directory_ttl:
+            return self.shards[cached[0]]
+
+        entry = self.directory.find_one({"user_id": user_id}) if self.directory is not None else None
+        name = entry["shard"] if entry and entry["shard"] in self.shards else self.ring_shard(user_id).name
+        self.directory_cache[user_id] = (name, time.monotonic())
+        return self.shards[name]
+
+    def assign(self, user_id: str) -> StorageShard:
+        """首次写入时记录用户所在分片"""
+        shard = self.shard_for(user_id)
+        if len(self.shards) > 1 and self.directory is not None:
+            self.directory.update_one(
+                {"user_id": user_id},
+                {"$setOnInsert": {"shard": shard.name, "assigned_at": datetime.now().isoformat()}},
+                upsert=True
+            )
+        return shard
+
+    def set_shard(self, user_id: str, shard_name: str, migrating_from: str = None):
+        """迁移时更新用户所在分片；migrating_from 记录尚未删除数据的源分片，迁移完成后清除"""
+        if self.directory is not None:
+            update = {"$set": {"shard": shard_name, "assigned_at": datetime.now().isoformat()}}
+            if migrating_from:
+                update["$set"]["migrating_from"] = migrating_from
+            else:
+                update["$unset"] = {"migrating_from": ""}
+            self.directory.update_one({"user_id": user_id}, update, upsert=True)
+        self.directory_cache[user_id] = (shard_name, time.monotonic())
+
+    def db_for(self, user_id: str):
+        return self.shard_for(user_id).db
+
+    def driver_for(self, user_id: str):
+        return self.shard_for(user_id).driver
+
+    def require_db(self, user_id: str):
+        shard_db = self.db_for(user_id)
+        if shard_db is None:
+            raise HTTPException(status_code=500, detail="数据库连接失败")
+        return shard_db
+
+    def require_driver(self, user_id: str):
+        driver = self.driver_for(user_id)
+        if not driver:
+            raise HTTPException(status_code=500, detail="Neo4j连接失败")
+        return driver
+
+storage_router = ShardRouter([
+    connect_storage_shard(config) for config in (json.loads(STORAGE_SHARDS) if STORAGE_SHARDS else [{}])
+])
 
 # DeepSeek API配置
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
 
+# 知识提取提示词版本（修改提取提示词时需同步递增，用于图谱溯源和批量重新提取）
+EXTRACTION_PROMPT_VERSION = "extract-v1"
+
+# LLM调用容错配置
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+# 客户端未传截止时间时，一次LLM调用（包括重试）的总时间上限
+LLM_DEFAULT_DEADLINE_SECONDS = float(os.getenv("LLM_DEFAULT_DEADLINE_SECONDS", "30"))
+# 失败后的最大重试次数，退避时间为 LLM_BACKOFF_BASE * 2^n 秒（上限 LLM_BACKOFF_MAX）内随机
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "4"))
+# 连续失败（超时、5xx、429或耗时超过 LLM_BREAKER_SLOW_SECONDS）达到阈值后熔断，
+# 熔断 LLM_BREAKER_RESET_SECONDS 秒后放行一个探测请求
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_SLOW_SECONDS = float(os.getenv("LLM_BREAKER_SLOW_SECONDS", "15"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+# 当前请求的截止时间（time.monotonic()），由客户端的 X-Request-Timeout 请求头（秒）设置
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+@app.middleware("http")
+async def propagate_request_deadline(request: Request, call_next):
+    token = None
+    timeout = request.headers.get("X-Request-Timeout")
+    if timeout:
+        try:
+            token = request_deadline.set(time.monotonic() + max(float(timeout), 0.0))
+        except ValueError:
+            pass
+    try:
+        return await call_next(request)
+    finally:
+        if token is not None:
+            request_deadline.reset(token)
+
+class LLMUnavailableError(Exception):
+    """LLM服务暂时不可用（熔断中、请求截止时间已到或重试后仍失败），调用方应返回降级结果"""
+
+class CircuitBreaker:
+    """熔断器：closed（正常）-> open（快速失败）-> half_open（放行一个探测请求）"""
+
+    def __init__(self, failure_threshold: int, slow_call_seconds: float, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.stats = {
+            "calls": 0, "successes": 0, "failures": 0, "slow_calls": 0,
+            "rejected": 0, "retries": 0, "times_opened": 0
+        }
+        self.last_latency = None
+        self.last_error = None
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                self.stats["rejected"] += 1
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.probe_in_flight:
+                self.stats["rejected"] += 1
+                return False
+            self.probe_in_flight = True
+        self.stats["calls"] += 1
+        return True
+
+    def record_success(self, latency: float):
+        self.last_latency = latency
+        if latency > self.slow_call_seconds:
+            self.stats["slow_calls"] += 1
+            self.record_failure(f"响应耗时 {latency:.1f}s")
+            return
+        self.stats["successes"] += 1
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+        if self.state != "closed":
+            print("LLM熔断器恢复")
+        self.state = "closed"
+
+    def record_aborted(self):
+        """调用被取消或异常中断、没有结果时释放探测名额；探测请求中断则重新熔断"""
+        if self.state == "half_open" and self.probe_in_flight:
+            self.probe_in_flight = False
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.stats["times_opened"] += 1
+
+    def record_failure(self, error: str):
+        self.stats["failures"] += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        self.probe_in_flight = False
+        if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= self.failure_threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.stats["times_opened"] += 1
+            print(f"LLM熔断器打开（连续失败 {self.consecutive_failures} 次）: {error}")
+
+    def retry_after(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(self.reset_seconds - (time.monotonic() - self.opened_at), 0.0)
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_after_seconds": round(self.retry_after(), 1),
+            "last_latency_seconds": round(self.last_latency, 3) if self.last_latency is not None else None,
+            "last_error": self.last_error,
+            **self.stats
+        }
+
+class DeepSeekClient:
+    """带截止时间、熔断和重试的DeepSeek对话接口调用
+
+    超时取 LLM_TIMEOUT_SECONDS 与截止时间剩余时间中的较小值，截止时间来自当前请求，
+    未传时为 LLM_DEFAULT_DEADLINE_SECONDS。对话接口调用没有副作用，超时、5xx或429后
+    在截止时间内按带随机抖动的指数退避重试。
+    """
+
+    def __init__(self, base_url: str, api_key: str, breaker: CircuitBreaker):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.breaker = breaker
+
+    async def chat_completion(self, messages: list, temperature: float, max_tokens: int = 2000) -> str:
+        deadline = request_deadline.get()
+        if deadline is None:
+            deadline = time.monotonic() + LLM_DEFAULT_DEADLINE_SECONDS
+        last_error = None
+        for attempt in range(1 + LLM_MAX_RETRIES):
+            if attempt > 0:
+                backoff = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** (attempt - 1)))
+                if deadline - time.monotonic() <= backoff:
+                    break
+                await asyncio.sleep(backoff)
+                self.breaker.stats["retries"] += 1
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LLMUnavailableError("请求已超过截止时间")
+            if not self.breaker.allow():
+                raise LLMUnavailableError(f"AI服务暂时不可用，{self.breaker.retry_after():.0f}秒后重试")
+
+            settled = False
+            try:
+                started = time.monotonic()
+                try:
+                    async with httpx.AsyncClient(timeout=min(LLM_TIMEOUT_SECONDS, remaining)) as client:
+                        response = await client.post(
+                            f"{self.base_url}/v1/chat/completions",
+                            headers={
+                                "Authorization": f"Bearer {self.api_key}",
+                                "Content-Type": "application/json"
+                            },
+                            json={
+                                "model": "deepseek-chat",
+                                "messages": messages,
+                                "temperature": temperature,
+                                "max_tokens": max_tokens
+                            }
+                        )
+                except httpx.HTTPError as e:
+                    last_error = f"{type(e).__name__}: {e}"
+                    print(f"DeepSeek API请求失败（第 {attempt + 1} 次）: {last_error}")
+                    settled = True
+                    self.breaker.record_failure(last_error)
+                    continue
+
+                latency = time.monotonic() - started
+                print(f"DeepSeek API响应状态码: {response.status_code}，耗时 {latency:.2f}s")
+                settled = True
+                if response.status_code == 429 or response.status_code >= 500:
+                    last_error = f"HTTP {response.status_code}: {response.text[:200]}"
+                    self.breaker.record_failure(last_error)
+                    continue
+
+                # 其余响应说明服务可用，错误属于请求本身，不计入熔断也不重试
+                self.breaker.record_success(latency)
+            finally:
+                # 调用被取消（客户端断开）或出现意外异常时也要释放探测名额
+                if not settled:
+                    self.breaker.record_aborted()
+
+            if response.status_code != 200:
+                raise Exception(f"HTTP {response.status_code}: {response.text}")
+            result = response.json()
+            if "choices" not in result or len(result["choices"]) == 0:
+                raise Exception(f"API响应格式错误: {result}")
+            return result["choices"][0]["message"]["content"]
+
+        raise LLMUnavailableError(f"AI服务请求失败: {last_error or '请求已超过截止时间'}")
+
+llm_breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_SLOW_SECONDS, LLM_BREAKER_RESET_SECONDS)
+llm_client = DeepSeekClient(DEEPSEEK_BASE_URL, DEEPSEEK_API_KEY, llm_breaker)
+
 # 数据模型
 class ConversationUpload(BaseModel):
     content: str
+    user_id: str = "default_user"
 
 class HealthQuestion(BaseModel):
     question: str
@@ -64,11 +415,13 @@ class ExtractionResult(BaseModel):
     relations: list
     created_at: str
 
+# 模型输出首尾的Markdown代码块标记
+JSON_FENCE_PATTERN = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+
 # DeepSeek知识提取服务
 class DeepSeekExtractor:
     def __init__(self):
         self.api_key = DEEPSEEK_API_KEY
-        self.base_url = DEEPSEEK_BASE_URL
         
     async def extract_knowledge(self, conversation: str) -> dict:
         """使用DeepSeek API提取知识"""
@@ -126,61 +479,195 @@ class DeepSeekExtractor:
 
         try:
             print(f"发送请求到DeepSeek API进行知识提取...")
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": "deepseek-chat",
-                        "messages": [
-                            {"role": "user", "content": prompt}
-                        ],
-                        "temperature": 0.1,
-                        "max_tokens": 2000
-                    },
-                    timeout=30.0
-                )
-                
-                print(f"知识提取API响应状态码: {response.status_code}")
-                print(f"知识提取API响应内容: {response.text[:500]}...")
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    content = result["choices"][0]["message"]["content"]
-                    print(f"知识提取成功，内容: {content[:200]}...")
-                    
-                    # 尝试解析JSON
-                    try:
-                        extracted_data = json.loads(content)
-                        return extracted_data
-                    except json.JSONDecodeError:
-                        # 如果JSON解析失败，返回默认结构
-                        return {
-                            "entities": [],
-                            "relations": []
-                        }
-                else:
-                    raise HTTPException(status_code=500, detail=f"DeepSeek API错误: {response.text}")
-                    
+            content = await llm_client.chat_completion(
+                [{"role": "user", "content": prompt}], temperature=0.1, max_tokens=2000
+            )
+            print(f"知识提取成功，内容: {content[:200]}...")
+        except LLMUnavailableError as e:
+            raise HTTPException(
+                status_code=503, detail=f"知识提取失败: {str(e)}",
+                headers={"Retry-After": str(math.ceil(llm_breaker.retry_after()) or 1)}
+            )
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"知识提取失败: {str(e)}")
 
+        # 解析JSON（模型可能把结果包在 ```json 代码块中）；解析失败时报错而不是返回空结果，
+        # 否则重新提取会按空结果撤销该会话在图谱中的全部内容
+        try:
+            extracted_data = json.loads(JSON_FENCE_PATTERN.sub("", content.strip()))
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=500, detail=f"知识提取失败: 无法解析模型输出为JSON（{e}）")
+        if not isinstance(extracted_data, dict):
+            raise HTTPException(status_code=500, detail="知识提取失败: 模型输出不是JSON对象")
+        return extracted_data
+
 extractor = DeepSeekExtractor()
 
+# 需要记录到健康时间线的实体类型
+TIMELINE_CATEGORIES = {
+    "症状": "symptom",
+    "疾病": "diagnosis",
+    "药物": "medication"
+}
+
+# 健康时间线服务
+class HealthTimelineStore:
+    """每次提及症状/疾病/药物记为一条带时间戳的事件，按 (user_id, 月份时间桶) 建索引"""
+
+    def __init__(self, router: ShardRouter):
+        self.router = router
+
+    @staticmethod
+    def time_bucket(moment: datetime) -> str:
+        """时间桶（按月）"""
+        return moment.strftime("%Y-%m")
+
+    @staticmethod
+    def encode_cursor(event: dict) -> str:
+        payload = json.dumps({"t": event["occurred_at"].isoformat(), "id": str(event["_id"])})
+        return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> tuple:
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            return datetime.fromisoformat(payload["t"]), ObjectId(payload["id"])
+        except Exception:
+            raise HTTPException(status_code=400, detail="无效的分页游标")
+
+    def record_session_events(self, session_id: str, user_id: str, extraction: dict, occurred_at: datetime):
+        """写入某个会话的提及事件（先清除该会话旧事件，重复提取保持幂等）"""
+        shard_db = self.router.db_for(user_id)
+        if shard_db is None:
+            return 0
+
+        events = []
+        for entity in extraction.get("entities", []):
+            entity_name = entity.get("name", "")
+            entity_type = entity.get("type", "")
+            if entity_name and entity_type in TIMELINE_CATEGORIES:
+                events.append({
+                    "user_id": user_id,
+                    "bucket": self.time_bucket(occurred_at),
+                    "occurred_at": occurred_at,
+                    "category": TIMELINE_CATEGORIES[entity_type],
+                    "name": entity_name,
+                    "type": entity_type,
+                    "confidence": entity.get("confidence", 0.0),
+                    "session_id": session_id,
+                    "prompt_version": extraction.get("prompt_version", "legacy")
+                })
+
+        shard_db.health_events.delete_many({"session_id": session_id})
+        if events:
+            shard_db.health_events.insert_many(events)
+        return len(events)
+
+    def remove_session_events(self, session_id: str, user_id: str):
+        """删除某个会话的全部提及事件"""
+        shard_db = self.router.db_for(user_id)
+        if shard_db is None:
+            return 0
+        return shard_db.health_events.delete_many({"session_id": session_id}).deleted_count
+
+    def _range_query(self, user_id: str, start: datetime = None, end: datetime = None) -> dict:
+        query = {"user_id": user_id}
+        bucket_range = {}
+        time_range = {}
+        if start:
+            bucket_range["$gte"] = self.time_bucket(start)
+            time_range["$gte"] = start
+        if end:
+            bucket_range["$lte"] = self.time_bucket(end)
+            time_range["$lt"] = end
+        if bucket_range:
+            query["bucket"] = bucket_range
+            query["occurred_at"] = time_range
+        return query
+
+    def query_events(self, user_id: str, start: datetime = None, end: datetime = None,
+                     limit: int = 50, cursor: str = None) -> dict:
+        """按时间范围倒序查询事件，使用游标分页"""
+        shard_db = self.router.require_db(user_id)
+
+        query = self._range_query(user_id, start, end)
+        if cursor:
+            cursor_time, cursor_id = self.decode_cursor(cursor)
+            cursor_bucket = self.time_bucket(cursor_time)
+            bucket_range = query.setdefault("bucket", {})
+            bucket_range["$lte"] = min(bucket_range.get("$lte", cursor_bucket), cursor_bucket)
+            query["$or"] = [
+                {"occurred_at": {"$lt": cursor_time}},
+                {"occurred_at": cursor_time, "_id": {"$lt": cursor_id}}
+            ]
+
+        events = list(
+            shard_db.health_events.find(query)
+            # 时间桶由发生时间得出，加上时间桶排序结果不变，且可以直接按索引顺序读取
+            .sort([("bucket", -1), ("occurred_at", -1), ("_id", -1)])
+            .limit(limit + 1)
+        )
+        has_more = len(events) > limit
+        events = events[:limit]
+        next_cursor = self.encode_cursor(events[-1]) if has_more else None
+
+        return {
+            "events": [
+                {
+                    "occurred_at": event["occurred_at"].isoformat(),
+                    "category": event["category"],
+                    "name": event["name"],
+                    "type": event["type"],
+                    "confidence": event.get("confidence", 0.0),
+                    "session_id": event["session_id"]
+                }
+                for event in events
+            ],
+            "next_cursor": next_cursor
+        }
+
+    def window_summary(self, user_id: str, days: int = 30) -> dict:
+        """汇总最近 days 天内的提及事件：每个实体的提及次数、首次/最近提及时间"""
+        shard_db = self.router.db_for(user_id)
+        if shard_db is None:
+            return {}
+
+        start = datetime.now() - timedelta(days=days)
+        pipeline = [
+            {"$match": self._range_query(user_id, start=start)},
+            {"$group": {
+                "_id": {"category": "$category", "name": "$name"},
+                "mentions": {"$sum": 1},
+                "confidence": {"$max": "$confidence"},
+                "first_seen": {"$min": "$occurred_at"},
+                "last_seen": {"$max": "$occurred_at"}
+            }},
+            {"$sort": {"last_seen": -1}}
+        ]
+
+        summary = {category: [] for category in TIMELINE_CATEGORIES.values()}
+        for item in shard_db.health_events.aggregate(pipeline):
+            summary[item["_id"]["category"]].append({
+                "name": item["_id"]["name"],
+                "mentions": item["mentions"],
+                "confidence": item["confidence"],
+                "first_seen": item["first_seen"].isoformat(),
+                "last_seen": item["last_seen"].isoformat()
+            })
+        return summary
+
+health_timeline = HealthTimelineStore(storage_router)
+
 # 健康分析服务
 class HealthAnalysisService:
-    def __init__(self, neo4j_driver):
-        self.driver = neo4j_driver
+    def __init__(self, router: ShardRouter):
+        self.router = router
         
     def get_user_health_summary(self, user_id: str = "default_user"):
         """获取用户健康信息摘要"""
-        if not self.driver:
-            raise HTTPException(status_code=500, detail="Neo4j连接失败")
+        driver = self.router.require_driver(user_id)
             
-        with self.driver.session() as session:
+        with driver.session() as session:
             # 获取用户的所有健康信息
             result = session.run("""
                 MATCH (u:User {user_id: $user_id})
@@ -251,12 +738,38 @@ class HealthAnalysisService:
                 
         return text
 
+    def build_llm_context(self, user_id: str, health_data: dict, days: int = 30) -> str:
+        """生成LLM上下文：最近 days 天的变化详细列出，更早的历史只列名称"""
+        window = health_timeline.window_summary(user_id, days)
+        if not any(window.values()):
+            return self.format_health_data_for_llm(health_data)
+
+        labels = {category: label for label, category in TIMELINE_CATEGORIES.items()}
+        text = f"用户近{days}天健康变化：\n\n"
+        recent_names = set()
+        for category, items in window.items():
+            if not items:
+                continue
+            text += f"{labels[category]}：\n"
+            for item in items:
+                recent_names.add(item["name"])
+                text += (f"- {item['name']} (提及{item['mentions']}次, 最近: {item['last_seen'][:10]}, "
+                         f"置信度: {item['confidence']:.2f})\n")
+            text += "\n"
+
+        older = []
+        for key, label in [("symptoms", "症状"), ("diseases", "疾病"), ("medications", "药物"),
+                           ("treatments", "治疗"), ("tests", "检查")]:
+            names = [item["name"] for item in health_data[key] if item["name"] not in recent_names]
+            if names:
+                older.append(f"{label}：{'、'.join(names)}")
+        if older:
+            text += "更早的健康记录：\n" + "\n".join(older) + "\n"
+
+        return text
+
 # 健康分析LLM服务
 class HealthAnalysisLLM:
-    def __init__(self):
-        self.api_key = os.getenv("DEEPSEEK_API_KEY")
-        self.base_url = "https://api.deepseek.com/v1/chat/completions"
-        
     async def generate_health_profile(self, health_data_text: str) -> dict:
         """生成健康档案"""
         prompt = f"""
@@ -293,6 +806,7 @@ class HealthAnalysisLLM:
             return {
                 "success": False,
                 "error": str(e),
+                "degraded": isinstance(e, LLMUnavailableError),
                 "timestamp": datetime.now().isoformat()
             }
     
@@ -334,410 +848,1963 @@ class HealthAnalysisLLM:
             return {
                 "success": False,
                 "error": str(e),
+                "degraded": isinstance(e, LLMUnavailableError),
                 "timestamp": datetime.now().isoformat()
             }
     
     async def _call_deepseek_api(self, prompt: str) -> str:
         """调用DeepSeek API"""
-        print(f"API Key: {self.api_key[:10]}..." if self.api_key else "API Key: None")
-        print(f"Base URL: {self.base_url}")
-        
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": "deepseek-chat",
-            "messages": [
+        print(f"发送请求到DeepSeek API...")
+        content = await llm_client.chat_completion(
+            [
                 {"role": "system", "content": "你是一位专业的健康分析师和顾问，擅长分析健康数据并提供专业建议。"},
                 {"role": "user", "content": prompt}
             ],
-            "temperature": 0.3,
-            "max_tokens": 2000
-        }
-        
-        print(f"发送请求到DeepSeek API...")
-        print(f"请求头: {headers}")
-        print(f"请求数据: {data}")
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            try:
-                response = await client.post(self.base_url, headers=headers, json=data)
-                print(f"响应状态码: {response.status_code}")
-                print(f"响应头: {dict(response.headers)}")
-                print(f"响应内容: {response.text[:500]}...")
-                
-                if response.status_code != 200:
-                    print(f"HTTP错误: {response.status_code} - {response.text}")
-                    raise Exception(f"HTTP {response.status_code}: {response.text}")
-                
-                response.raise_for_status()
-                result = response.json()
-                print(f"解析后的结果: {result}")
-                
-                if "choices" not in result or len(result["choices"]) == 0:
-                    print(f"API响应格式错误: {result}")
-                    raise Exception(f"API响应格式错误: {result}")
-                
-                content = result["choices"][0]["message"]["content"]
-                print(f"提取的内容: {content[:200]}...")
-                return content
-                
-            except httpx.TimeoutException as e:
-                print(f"请求超时: {e}")
-                raise Exception(f"请求超时: {e}")
-            except httpx.HTTPStatusError as e:
-                print(f"HTTP状态错误: {e.response.status_code} - {e.response.text}")
-                raise Exception(f"HTTP {e.response.status_code}: {e.response.text}")
-            except Exception as e:
-                print(f"其他错误: {type(e).__name__}: {e}")
-                raise
+            temperature=0.3,
+            max_tokens=2000
+        )
+        print(f"提取的内容: {content[:200]}...")
+        return content
 
 # 初始化服务
-health_analysis_service = HealthAnalysisService(neo4j_driver)
+health_analysis_service = HealthAnalysisService(storage_router)
 health_analysis_llm = HealthAnalysisLLM()
 
-# 图谱构建服务
-class KnowledgeGraphBuilder:
-    def __init__(self, neo4j_driver):
-        self.driver = neo4j_driver
-        
-    def build_user_knowledge_graph(self, session_id: str, user_id: str = "default_user"):
-        """构建用户知识图谱"""
-        if not self.driver:
-            raise HTTPException(status_code=500, detail="Neo4j连接失败")
-            
-        # 从MongoDB获取提取结果
-        extraction = db.extractions.find_one({"session_id": session_id})
-        if not extraction:
-            raise HTTPException(status_code=404, detail="提取结果不存在")
-            
-        with self.driver.session() as session:
-            # 创建或更新用户节点
-            session.run("""
-                MERGE (u:User {user_id: $user_id})
-                SET u.last_updated = datetime()
-            """, user_id=user_id)
-            
-            # 处理实体
-            for entity in extraction.get("entities", []):
-                entity_name = entity.get("name", "")
-                entity_type = entity.get("type", "")
-                confidence = entity.get("confidence", 0.0)
-                
-                if entity_name and entity_type:
-                    # 创建实体节点
-                    session.run("""
-                        MERGE (e:Entity {name: $name, type: $type})
-                        SET e.confidence = $confidence,
-                            e.last_updated = datetime(),
-                            e.source_session = $session_id
-                    """, name=entity_name, type=entity_type, confidence=confidence, session_id=session_id)
-                    
-                    # 创建用户与实体的关系
-                    if entity_type == "症状":
-                        session.run("""
-                            MATCH (u:User {user_id: $user_id})
-                            MATCH (e:Entity {name: $name, type: $type})
-                            MERGE (u)-[r:HAS_SYMPTOM]->(e)
-                            SET r.confidence = $confidence,
-                                r.session_id = $session_id,
-                                r.created_at = datetime()
-                        """, user_id=user_id, name=entity_name, type=entity_type, confidence=confidence, session_id=session_id)
-                    elif entity_type == "疾病":
-                        session.run("""
-                            MATCH (u:User {user_id: $user_id})
-                            MATCH (e:Entity {name: $name, type: $type})
-                            MERGE (u)-[r:HAS_DIAGNOSIS]->(e)
-                            SET r.confidence = $confidence,
-                                r.session_id = $session_id,
-                                r.created_at = datetime()
-                        """, user_id=user_id, name=entity_name, type=entity_type, confidence=confidence, session_id=session_id)
-                    elif entity_type == "药物":
-                        session.run("""
-                            MATCH (u:User {user_id: $user_id})
-                            MATCH (e:Entity {name: $name, type: $type})
-                            MERGE (u)-[r:USES_MEDICATION]->(e)
-                            SET r.confidence = $confidence,
-                                r.session_id = $session_id,
-                                r.created_at = datetime()
-                        """, user_id=user_id, name=entity_name, type=entity_type, confidence=confidence, session_id=session_id)
-            
-            # 处理关系
-            for relation in extraction.get("relations", []):
-                relation_type = relation.get("type", "")
-                source = relation.get("source", "")
-                target = relation.get("target", "")
-                confidence = relation.get("confidence", 0.0)
-                
-                if relation_type and source and target:
-                    session.run("""
-                        MATCH (s:Entity {name: $source})
-                        MATCH (t:Entity {name: $target})
-                        MERGE (s)-[r:RELATION {type: $relation_type}]->(t)
-                        SET r.confidence = $confidence,
-                            r.session_id = $session_id,
-                            r.created_at = datetime()
-                    """, source=source, target=target, relation_type=relation_type, confidence=confidence, session_id=session_id)
-    
-    def get_user_knowledge_graph(self, user_id: str = "default_user"):
-        """获取用户知识图谱数据"""
-        if not self.driver:
-            raise HTTPException(status_code=500, detail="Neo4j连接失败")
-            
-        try:
-            with self.driver.session() as session:
-                # 查询所有节点
-                nodes_result = session.run("""
-                    MATCH (n)
-                    WHERE n:User OR n:Entity
-                    RETURN n
-                """)
-                
-                # 查询所有关系
-                edges_result = session.run("""
-                    MATCH (a)-[r]->(b)
-                    RETURN a, r, b
-                """)
-                
-                nodes = []
-                edges = []
-                node_ids = set()
-                
-                # 处理节点
-                for record in nodes_result:
-                    node_data = dict(record["n"])
-                    
-                    if "user_id" in node_data:
-                        # 用户节点
-                        node_id = node_data["user_id"]
-                        if node_id not in node_ids:
-                            nodes.append({
-                                "id": node_id,
-                                "label": "用户",
-                                "type": "User",
-                                "group": "user"
-                            })
-                            node_ids.add(node_id)
-                    elif "name" in node_data and "type" in node_data:
-                        # 实体节点
-                        node_id = f"{node_data['name']}_{node_data['type']}"
-                        if node_id not in node_ids:
-                            nodes.append({
-                                "id": node_id,
-                                "label": node_data["name"],
-                                "type": node_data["type"],
-                                "group": node_data["type"].lower(),
-                                "confidence": node_data.get("confidence", 0.0)
-                            })
-                            node_ids.add(node_id)
-                
-                # 处理关系
-                for record in edges_result:
-                    source_data = dict(record["a"])
-                    target_data = dict(record["b"])
-                    rel = record["r"]
-                    
-                    # 确定源节点ID
-                    if "user_id" in source_data:
-                        source_id = source_data["user_id"]
-                    elif "name" in source_data and "type" in source_data:
-                        source_id = f"{source_data['name']}_{source_data['type']}"
-                    else:
-                        continue
-                    
-                    # 确定目标节点ID
-                    if "user_id" in target_data:
-                        target_id = target_data["user_id"]
-                    elif "name" in target_data and "type" in target_data:
-                        target_id = f"{target_data['name']}_{target_data['type']}"
-                    else:
-                        continue
-                    
-                    # 获取关系类型
-                    rel_type = rel.type if hasattr(rel, 'type') else 'RELATION'
-                    
-                    edges.append({
-                        "id": f"{source_id}_{target_id}_{rel_type}",
-                        "source": source_id,
-                        "target": target_id,
-                        "label": rel_type,
-                        "confidence": 0.0
-                    })
-                
-                return {
-                    "nodes": nodes,
-                    "edges": edges
-                }
-        except Exception as e:
-            print(f"图谱查询错误: {e}")
-            raise HTTPException(status_code=500, detail=f"获取图谱失败: {str(e)}")
+# 健康档案预生成配置（图谱变化后延迟生成的秒数，连续多次提取只生成一次）
+PROFILE_DEBOUNCE_SECONDS = float(os.getenv("PROFILE_DEBOUNCE_SECONDS", "10"))
 
-graph_builder = KnowledgeGraphBuilder(neo4j_driver)
+def count_health_items(health_data: dict) -> int:
+    return (len(health_data["symptoms"]) + len(health_data["diseases"]) +
+            len(health_data["medications"]) + len(health_data["treatments"]) +
+            len(health_data["tests"]))
 
-# API路由
-@app.post("/upload")
-async def upload_conversation(conversation: ConversationUpload):
-    """上传对话"""
-    if db is None:
-        raise HTTPException(status_code=500, detail="数据库连接失败")
-    
-    # 生成会话ID
-    session_id = f"SESS_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{str(uuid.uuid4())[:8]}"
-    
-    # 存储对话
-    conversation_doc = {
-        "session_id": session_id,
-        "content": conversation.content,
-        "created_at": datetime.now().isoformat(),
-        "processed": False
-    }
-    
-    try:
-        result = db.conversations.insert_one(conversation_doc)
-        return {
-            "success": True,
-            "session_id": session_id,
-            "message": "对话上传成功"
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"存储失败: {str(e)}")
+# 健康档案预生成服务
+class HealthProfileService:
+    """图谱变化后在后台生成健康档案，按版本存入MongoDB
 
-@app.post("/extract/{session_id}")
-async def extract_knowledge(session_id: str):
-    """提取知识"""
-    if db is None:
-        raise HTTPException(status_code=500, detail="数据库连接失败")
-    
-    # 查找对话
-    conversation = db.conversations.find_one({"session_id": session_id})
-    if not conversation:
-        raise HTTPException(status_code=404, detail="对话不存在")
-    
-    try:
-        # 提取知识
-        extraction_result = await extractor.extract_knowledge(conversation["content"])
-        
-        # 存储提取结果
-        extraction_doc = {
-            "session_id": session_id,
-            "entities": extraction_result.get("entities", []),
-            "relations": extraction_result.get("relations", []),
-            "created_at": datetime.now().isoformat()
-        }
-        
-        result = db.extractions.insert_one(extraction_doc)
-        
-        # 更新对话状态
-        db.conversations.update_one(
-            {"session_id": session_id},
-            {"$set": {"processed": True}}
+    profile_state 集合记录每个用户的图谱版本（每次图谱变化加1），health_profiles 集合
+    按 version 保存每次生成的档案及其基于的图谱版本；档案基于的版本落后即为过期。
+    """
+
+    def __init__(self, router: ShardRouter, debounce_seconds: float = PROFILE_DEBOUNCE_SECONDS):
+        self.router = router
+        self.debounce_seconds = debounce_seconds
+        self.loop = None
+        self.timers = {}     # user_id -> 延迟生成的定时器
+        self.running = set()
+        self.rerun = set()
+        self.tasks = set()
+
+    def graph_version(self, user_id: str) -> int:
+        state = self.router.require_db(user_id).profile_state.find_one({"user_id": user_id})
+        return state["graph_version"] if state else 0
+
+    def latest_profile(self, user_id: str):
+        return self.router.require_db(user_id).health_profiles.find_one(
+            {"user_id": user_id}, sort=[("version", -1)]
         )
-        
-        # 构建知识图谱
+
+    def mark_graph_changed(self, user_id: str):
+        """记录图谱变化并安排延迟生成"""
+        shard_db = self.router.db_for(user_id)
+        if shard_db is None:
+            return
+        shard_db.profile_state.update_one(
+            {"user_id": user_id},
+            {"$inc": {"graph_version": 1}, "$set": {"graph_updated_at": datetime.now().isoformat()}},
+            upsert=True
+        )
+        self.schedule(user_id)
+
+    def schedule(self, user_id: str, delay: float = None):
+        """安排后台生成（可在任意线程调用）；延迟期间再次调用会重新计时"""
+        if self.loop is None:
+            return
+        delay = self.debounce_seconds if delay is None else delay
+        # 在空的上下文中运行，后台生成不继承调用方请求的截止时间等上下文变量
+        self.loop.call_soon_threadsafe(self._schedule, user_id, delay, context=contextvars.Context())
+
+    def _schedule(self, user_id: str, delay: float):
+        timer = self.timers.pop(user_id, None)
+        if timer:
+            timer.cancel()
+        self.timers[user_id] = self.loop.call_later(delay, self._start, user_id)
+
+    def _start(self, user_id: str):
+        self.timers.pop(user_id, None)
+        if user_id in self.running:
+            # 正在生成，结束后再检查一次是否过期
+            self.rerun.add(user_id)
+            return
+        self.running.add(user_id)
+        task = self.loop.create_task(self._run(user_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, user_id: str):
         try:
-            graph_builder.build_user_knowledge_graph(session_id)
+            await self.regenerate(user_id)
         except Exception as e:
-            print(f"图谱构建失败: {e}")
-        
-        # 移除ObjectId以避免序列化错误
-        extraction_doc.pop("_id", None)
-        
+            print(f"后台生成健康档案失败 {user_id}: {e}")
+        finally:
+            self.running.discard(user_id)
+            if user_id in self.rerun:
+                self.rerun.discard(user_id)
+                self._schedule(user_id, 0)
+
+    @staticmethod
+    def _storable_health_data(health_data: dict) -> dict:
+        """Neo4j时间类型转为字符串后才能存入MongoDB"""
         return {
-            "success": True,
-            "session_id": session_id,
-            "extraction": extraction_doc
+            key: [
+                {**item, "created_at": str(item["created_at"]) if item.get("created_at") is not None else None}
+                for item in items
+            ]
+            for key, items in health_data.items()
         }
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"知识提取失败: {str(e)}")
 
-@app.get("/result/{session_id}")
-async def get_result(session_id: str):
-    """获取提取结果"""
-    if db is None:
-        raise HTTPException(status_code=500, detail="数据库连接失败")
-    
-    # 查找提取结果
-    result = db.extractions.find_one({"session_id": session_id})
-    if not result:
-        raise HTTPException(status_code=404, detail="提取结果不存在")
-    
-    # 移除ObjectId以避免序列化错误
-    result.pop("_id", None)
-    
-    return {
-        "success": True,
-        "session_id": session_id,
-        "entities": result["entities"],
-        "relations": result["relations"],
-        "created_at": result["created_at"]
-    }
+    async def regenerate(self, user_id: str, force: bool = False):
+        """生成并保存新版本档案；档案已是最新时跳过（force=True 时总是生成）"""
+        graph_version = self.graph_version(user_id)
+        latest = self.latest_profile(user_id)
+        if latest and not force and latest["graph_version"] >= graph_version:
+            return latest
 
-@app.get("/graph/{user_id}")
-async def get_knowledge_graph(user_id: str = "default_user"):
-    """获取用户知识图谱"""
-    try:
-        graph_data = graph_builder.get_user_knowledge_graph(user_id)
-        return {
-            "success": True,
+        health_data = health_analysis_service.get_user_health_summary(user_id)
+        if count_health_items(health_data) == 0:
+            return None
+
+        health_data_text = health_analysis_service.build_llm_context(user_id, health_data)
+        result = await health_analysis_llm.generate_health_profile(health_data_text)
+        if not result["success"]:
+            print(f"生成健康档案失败 {user_id}: {result.get('error')}")
+            if latest is None:
+                if result.get("degraded"):
+                    raise LLMUnavailableError(result.get("error"))
+                raise RuntimeError(result.get("error"))
+            return latest
+
+        profile_doc = {
             "user_id": user_id,
-            "graph": graph_data
+            "version": (latest["version"] + 1) if latest else 1,
+            "graph_version": graph_version,
+            "health_data": self._storable_health_data(health_data),
+            "profile": result["profile"],
+            "generated_at": result["timestamp"]
         }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"获取图谱失败: {str(e)}")
+        # 后台生成和 refresh=true 的同步生成可能同时进行，版本号冲突时取最新版本加1重试
+        shard_db = self.router.require_db(user_id)
+        while True:
+            try:
+                shard_db.health_profiles.insert_one(profile_doc)
+                break
+            except DuplicateKeyError:
+                profile_doc.pop("_id", None)
+                profile_doc["version"] = self.latest_profile(user_id)["version"] + 1
+        print(f"健康档案已更新 {user_id} v{profile_doc['version']}")
+        return profile_doc
 
-@app.post("/graph/build/{session_id}")
-async def build_knowledge_graph(session_id: str, user_id: str = "default_user"):
-    """手动构建知识图谱"""
-    try:
-        graph_builder.build_user_knowledge_graph(session_id, user_id)
+    def freshness(self, user_id: str, profile_doc: dict) -> dict:
+        graph_version = self.graph_version(user_id)
+        stale = profile_doc["graph_version"] < graph_version
+        if stale:
+            status = "regenerating" if user_id in self.running or user_id in self.timers else "stale"
+        else:
+            status = "fresh"
         return {
-            "success": True,
-            "session_id": session_id,
-            "user_id": user_id,
-            "message": "图谱构建成功"
+            "status": status,
+            "version": profile_doc["version"],
+            "graph_version": graph_version,
+            "profile_graph_version": profile_doc["graph_version"],
+            "generated_at": profile_doc["generated_at"]
         }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"图谱构建失败: {str(e)}")
 
-# 第三阶段：智能健康问答API
+health_profile_service = HealthProfileService(storage_router)
+
+# 图谱实时推送配置（每个进程的WebSocket连接上限、每个连接的消息队列长度）
+GRAPH_WS_MAX_CONNECTIONS = int(os.getenv("GRAPH_WS_MAX_CONNECTIONS", "100"))
+GRAPH_WS_QUEUE_SIZE = int(os.getenv("GRAPH_WS_QUEUE_SIZE", "32"))
+
+# 图谱更新发布/订阅服务
+class GraphUpdateBus:
+    """进程内发布/订阅：按用户推送刚写入图谱的节点和关系"""
+
+    def __init__(self, max_connections: int, queue_size: int):
+        self.max_connections = max_connections
+        self.queue_size = queue_size
+        self.subscribers = {}   # user_id -> 消息队列集合
+        self.connections = 0
+        self.loop = None
+
+    def subscribe(self, user_id: str):
+        """订阅某个用户的图谱更新，超过连接上限时返回None"""
+        if self.connections >= self.max_connections:
+            return None
+        self.loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        self.connections += 1
+        return queue
+
+    def unsubscribe(self, user_id: str, queue):
+        queues = self.subscribers.get(user_id)
+        if queues and queue in queues:
+            queues.discard(queue)
+            self.connections -= 1
+            if not queues:
+                del self.subscribers[user_id]
+
+    def publish(self, user_id: str, message: dict):
+        """发布更新（可在任意线程调用），消息只序列化一次"""
+        if user_id not in self.subscribers or self.loop is None:
+            return
+        payload = orjson.dumps(message).decode("utf-8")
+        self.loop.call_soon_threadsafe(self._deliver, user_id, payload)
+
+    def _deliver(self, user_id: str, payload: str):
+        for queue in list(self.subscribers.get(user_id, ())):
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                # 客户端消费过慢：丢弃积压的增量，通知其重新加载完整图谱
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(orjson.dumps({"type": "resync"}).decode("utf-8"))
+
+graph_update_bus = GraphUpdateBus(GRAPH_WS_MAX_CONNECTIONS, GRAPH_WS_QUEUE_SIZE)
+
+# 实体类型与用户关系类型的映射
+USER_RELATION_TYPES = {
+    "症状": "HAS_SYMPTOM",
+    "疾病": "HAS_DIAGNOSIS",
+    "药物": "USES_MEDICATION"
+}
+
+def lineage_tag(session_id: str, prompt_version: str) -> str:
+    """图谱贡献的溯源标签：来源会话@提示词版本"""
+    return f"{session_id}@{prompt_version}"
+
+# 从溯源列表中移除某个会话的标签（Cypher片段，$prefix 为 "session_id@"）
+LINEAGE_WITHOUT_SESSION = "[t IN coalesce({var}.lineage, []) WHERE NOT t STARTS WITH $prefix]"
+
+# 图谱构建服务
+class KnowledgeGraphBuilder:
+    # 流式输出时每次写出的节点/关系条数
+    STREAM_BATCH_ITEMS = 500
+
+    def __init__(self, router: ShardRouter):
+        self.router = router
+
+    @staticmethod
+    def _index_extraction(extraction) -> tuple:
+        """按实体/关系键为提取结果建立索引，便于计算差异"""
+        entities = {}
+        relations = {}
+        if not extraction:
+            return entities, relations
+
+        for entity in extraction.get("entities", []):
+            entity_name = entity.get("name", "")
+            entity_type = entity.get("type", "")
+            if entity_name and entity_type:
+                entities[(entity_name, entity_type)] = entity.get("confidence", 0.0)
+
+        for relation in extraction.get("relations", []):
+            relation_type = relation.get("type", "")
+            source = relation.get("source", "")
+            target = relation.get("target", "")
+            if relation_type and source and target:
+                relations[(relation_type, source, target)] = relation.get("confidence", 0.0)
+
+        return entities, relations
+
+    def diff_extractions(self, previous, current) -> dict:
+        """计算同一会话两次提取结果的差异，只返回需要写入或撤销的部分"""
+        prev_entities, prev_relations = self._index_extraction(previous)
+        cur_entities, cur_relations = self._index_extraction(current)
+        # 提示词版本变化时需要重写全部溯源标签
+        version_changed = (previous or {}).get("prompt_version") != (current or {}).get("prompt_version")
+
+        return {
+            "upsert_entities": [
+                {"name": name, "type": entity_type, "confidence": confidence}
+                for (name, entity_type), confidence in cur_entities.items()
+                if version_changed or prev_entities.get((name, entity_type)) != confidence
+            ],
+            "remove_entities": [
+                {"name": name, "type": entity_type}
+                for (name, entity_type) in prev_entities
+                if (name, entity_type) not in cur_entities
+            ],
+            "upsert_relations": [
+                {"type": relation_type, "source": source, "target": target, "confidence": confidence}
+                for (relation_type, source, target), confidence in cur_relations.items()
+                if version_changed or prev_relations.get((relation_type, source, target)) != confidence
+            ],
+            "remove_relations": [
+                {"type": relation_type, "source": source, "target": target}
+                for (relation_type, source, target) in prev_relations
+                if (relation_type, source, target) not in cur_relations
+            ]
+        }
+
+    @staticmethod
+    def _apply_graph_diff(tx, diff: dict, session_id: str, user_id: str, prompt_version: str):
+        """在单个事务中写入提取差异，所有贡献都带有会话和提示词版本标签；返回删除的关系和节点数"""
+        params = {
+            "user_id": user_id,
+            "session_id": session_id,
+            "prefix": f"{session_id}@",
+            "tag": lineage_tag(session_id, prompt_version)
+        }
+
+        # 创建或更新用户节点
+        tx.run("""
+            MERGE (u:User {user_id: $user_id})
+            SET u.last_updated = datetime()
+        """, **params)
+
+        deleted = {"relationships": 0, "nodes": 0}
+
+        # 撤销本会话不再提取到的关系
+        if diff["remove_entities"]:
+            summary = tx.run(f"""
+                UNWIND $items AS item
+                MATCH (u:User {{user_id: $user_id}})-[r]->(e:Entity {{name: item.name, type: item.type}})
+                WHERE type(r) IN $relation_types
+                SET r.lineage = {LINEAGE_WITHOUT_SESSION.format(var="r")}
+                WITH r WHERE size(r.lineage) = 0
+                DELETE r
+            """, items=diff["remove_entities"], relation_types=list(USER_RELATION_TYPES.values()), **params).consume()
+            deleted["relationships"] += summary.counters.relationships_deleted
+
+        if diff["remove_relations"]:
+            summary = tx.run(f"""
+                UNWIND $items AS item
+                MATCH (s:Entity {{name: item.source}})-[r:RELATION {{type: item.type}}]->(t:Entity {{name: item.target}})
+                SET r.lineage = {LINEAGE_WITHOUT_SESSION.format(var="r")}
+                WITH r WHERE size(r.lineage) = 0
+                DELETE r
+            """, items=diff["remove_relations"], **params).consume()
+            deleted["relationships"] += summary.counters.relationships_deleted
+
+        # 撤销本会话不再提取到的实体，没有其他来源且无关系的实体直接删除
+        if diff["remove_entities"]:
+            summary = tx.run(f"""
+                UNWIND $items AS item
+                MATCH (e:Entity {{name: item.name, type: item.type}})
+                SET e.lineage = {LINEAGE_WITHOUT_SESSION.format(var="e")}
+                WITH e WHERE size(e.lineage) = 0 AND NOT (e)--()
+                DELETE e
+            """, items=diff["remove_entities"], **params).consume()
+            deleted["nodes"] += summary.counters.nodes_deleted
+
+        # 写入新增或变化的实体
+        if diff["upsert_entities"]:
+            tx.run(f"""
+                UNWIND $items AS item
+                MERGE (e:Entity {{name: item.name, type: item.type}})
+                SET e.confidence = item.confidence,
+                    e.last_updated = datetime(),
+                    e.source_session = $session_id,
+                    e.lineage = {LINEAGE_WITHOUT_SESSION.format(var="e")} + $tag
+            """, items=diff["upsert_entities"], **params)
+
+        # 创建用户与实体的关系（关系类型不能参数化，按类型分批写入）
+        for entity_type, relation_type in USER_RELATION_TYPES.items():
+            items = [item for item in diff["upsert_entities"] if item["type"] == entity_type]
+            if not items:
+                continue
+            tx.run(f"""
+                UNWIND $items AS item
+                MATCH (u:User {{user_id: $user_id}})
+                MATCH (e:Entity {{name: item.name, type: item.type}})
+                MERGE (u)-[r:{relation_type}]->(e)
+                ON CREATE SET r.created_at = datetime()
+                SET r.confidence = item.confidence,
+                    r.session_id = $session_id,
+                    r.updated_at = datetime(),
+                    r.lineage = {LINEAGE_WITHOUT_SESSION.format(var="r")} + $tag
+            """, items=items, **params)
+
+        # 处理实体间关系
+        if diff["upsert_relations"]:
+            tx.run(f"""
+                UNWIND $items AS item
+                MATCH (s:Entity {{name: item.source}})
+                MATCH (t:Entity {{name: item.target}})
+                MERGE (s)-[r:RELATION {{type: item.type}}]->(t)
+                ON CREATE SET r.created_at = datetime()
+                SET r.confidence = item.confidence,
+                    r.session_id = $session_id,
+                    r.updated_at = datetime(),
+                    r.lineage = {LINEAGE_WITHOUT_SESSION.format(var="r")} + $tag
+            """, items=diff["upsert_relations"], **params)
+
+        return deleted
+
+    @staticmethod
+    def _graph_patch(diff: dict, user_id: str, extraction: dict) -> dict:
+        """根据写入的差异生成推送给前端的增量（格式与 /graph 接口一致）"""
+        nodes = [{"id": user_id, "label": "用户", "type": "User", "group": "user"}]
+        edges = []
+        for item in diff["upsert_entities"]:
+            node_id = f"{item['name']}_{item['type']}"
+            nodes.append({
+                "id": node_id,
+                "label": item["name"],
+                "type": item["type"],
+                "group": item["type"].lower(),
+                "confidence": item["confidence"]
+            })
+            relation_type = USER_RELATION_TYPES.get(item["type"])
+            if relation_type:
+                edges.append({
+                    "id": f"{user_id}_{node_id}_{relation_type}",
+                    "source": user_id,
+                    "target": node_id,
+                    "label": relation_type,
+                    "confidence": 0.0
+                })
+
+        # 实体间关系只按名称匹配，用本次提取的实体类型确定节点ID
+        entity_types = {}
+        for entity in extraction.get("entities", []):
+            if entity.get("name") and entity.get("type"):
+                entity_types.setdefault(entity["name"], entity["type"])
+        for item in diff["upsert_relations"]:
+            if item["source"] not in entity_types or item["target"] not in entity_types:
+                continue
+            source_id = f"{item['source']}_{entity_types[item['source']]}"
+            target_id = f"{item['target']}_{entity_types[item['target']]}"
+            edges.append({
+                "id": f"{source_id}_{target_id}_RELATION",
+                "source": source_id,
+                "target": target_id,
+                "label": "RELATION",
+                "confidence": 0.0
+            })
+
+        return {"type": "patch", "nodes": nodes, "edges": edges}
+
+    @staticmethod
+    def applied_snapshot(extraction) -> dict:
+        """已写入图谱的提取内容，保存在提取结果的 applied 字段中"""
+        return {
+            "entities": extraction.get("entities", []),
+            "relations": extraction.get("relations", []),
+            "prompt_version": extraction.get("prompt_version", "legacy")
+        }
+
+    def build_user_knowledge_graph(self, session_id: str, user_id: str = "default_user", full: bool = False):
+        """构建用户知识图谱
+
+        总是与该会话最后一次成功写入图谱的内容（applied 字段）计算差异，只写入差异；
+        中间某次写入失败时下一次仍基于最后成功的版本撤销多余内容。
+        full=True 时重写当前提取的全部内容（溯源标签按会话去重，重复执行是幂等的）。
+        """
+        driver = self.router.require_driver(user_id)
+        shard_db = self.router.require_db(user_id)
+            
+        # 从MongoDB获取提取结果
+        extraction = shard_db.extractions.find_one({"session_id": session_id})
+        if not extraction or extraction.get("user_id", "default_user") != user_id:
+            raise HTTPException(status_code=404, detail="提取结果不存在")
+
+        prompt_version = extraction.get("prompt_version", "legacy")
+        diff = self.diff_extractions(extraction.get("applied"), extraction)
+        if full:
+            full_diff = self.diff_extractions(None, extraction)
+            diff["upsert_entities"] = full_diff["upsert_entities"]
+            diff["upsert_relations"] = full_diff["upsert_relations"]
+
+        with driver.session() as session:
+            session.execute_write(self._apply_graph_diff, diff, session_id, user_id, prompt_version)
+
+        # 写入成功后才更新已写入快照
+        shard_db.extractions.update_one(
+            {"session_id": session_id},
+            {"$set": {
+                "applied": self.applied_snapshot(extraction),
+                "graph_applied": True,
+                "user_id": user_id,
+                "graph_updated_at": datetime.now().isoformat()
+            }}
+        )
+
+        # 记录健康时间线事件，时间取对话上传时间
+        conversation = shard_db.conversations.find_one({"session_id": session_id}, {"created_at": 1})
+        try:
+            occurred_at = datetime.fromisoformat(conversation["created_at"])
+        except (TypeError, KeyError, ValueError):
+            occurred_at = datetime.now()
+        health_timeline.record_session_events(session_id, user_id, extraction, occurred_at)
+
+        # 图谱有变化时安排后台重新生成健康档案
+        if any(diff.values()):
+            health_profile_service.mark_graph_changed(user_id)
+
+        # 推送增量给订阅该用户的前端（没有新增或更新时不推送）；有删除时通知重新加载
+        if diff["upsert_entities"] or diff["upsert_relations"]:
+            graph_update_bus.publish(user_id, self._graph_patch(diff, user_id, extraction))
+        if diff["remove_entities"] or diff["remove_relations"]:
+            graph_update_bus.publish(user_id, {"type": "resync"})
+
+        return {key: len(items) for key, items in diff.items()}
+
+    def rollback_session(self, session_id: str, user_id: str = "default_user") -> dict:
+        """回滚某个会话写入图谱的全部内容
+
+        按 applied 快照中该会话写入的实体和关系逐个撤销溯源标签，不扫描整个图谱。
+        """
+        driver = self.router.require_driver(user_id)
+        shard_db = self.router.db_for(user_id)
+
+        extraction = shard_db.extractions.find_one({"session_id": session_id}) if shard_db is not None else None
+        if extraction and extraction.get("user_id", "default_user") != user_id:
+            raise HTTPException(status_code=404, detail="提取结果不存在")
+        applied = extraction.get("applied") if extraction else None
+
+        deleted = {"relationships": 0, "nodes": 0}
+        if applied:
+            diff = self.diff_extractions(applied, None)
+            with driver.session() as session:
+                deleted = session.execute_write(
+                    self._apply_graph_diff, diff, session_id, user_id, applied.get("prompt_version", "legacy")
+                )
+        deleted["events"] = health_timeline.remove_session_events(session_id, user_id)
+        graph_update_bus.publish(user_id, {"type": "resync"})
+        health_profile_service.mark_graph_changed(user_id)
+
+        if extraction:
+            shard_db.extractions.update_one(
+                {"session_id": session_id},
+                {
+                    "$set": {"graph_applied": False, "graph_updated_at": datetime.now().isoformat()},
+                    "$unset": {"applied": ""}
+                }
+            )
+
+        return deleted
+    
+    @staticmethod
+    def _graph_node_id(node):
+        """图谱节点ID：用户节点用user_id，实体节点用 名称_类型"""
+        if "user_id" in node:
+            return node["user_id"]
+        if "name" in node and "type" in node:
+            return f"{node['name']}_{node['type']}"
+        return None
+
+    def _iter_graph_nodes(self, session):
+        """逐条读取Neo4j结果并生成节点数据（不缓存整个结果集，节点ID在Cypher中去重）"""
+        result = session.run("""
+            MATCH (n)
+            WHERE n:User OR n:Entity
+            WITH n, CASE WHEN n.user_id IS NOT NULL THEN n.user_id ELSE n.name + '_' + n.type END AS node_id
+            WHERE node_id IS NOT NULL
+            RETURN node_id, n.user_id IS NOT NULL AS is_user, n.name AS name, n.type AS type,
+                   max(coalesce(n.confidence, 0.0)) AS confidence
+        """)
+        for record in result:
+            if record["is_user"]:
+                # 用户节点
+                yield {
+                    "id": record["node_id"],
+                    "label": "用户",
+                    "type": "User",
+                    "group": "user"
+                }
+            else:
+                # 实体节点
+                yield {
+                    "id": record["node_id"],
+                    "label": record["name"],
+                    "type": record["type"],
+                    "group": record["type"].lower(),
+                    "confidence": record["confidence"]
+                }
+
+    def _iter_graph_edges(self, session):
+        """逐条读取Neo4j结果并生成关系数据"""
+        result = session.run("""
+            MATCH (a)-[r]->(b)
+            RETURN a, r, b
+        """)
+        for record in result:
+            source_id = self._graph_node_id(record["a"])
+            target_id = self._graph_node_id(record["b"])
+            if source_id is None or target_id is None:
+                continue
+
+            # 获取关系类型
+            rel = record["r"]
+            rel_type = rel.type if hasattr(rel, 'type') else 'RELATION'
+
+            yield {
+                "id": f"{source_id}_{target_id}_{rel_type}",
+                "source": source_id,
+                "target": target_id,
+                "label": rel_type,
+                "confidence": 0.0
+            }
+
+    def get_user_knowledge_graph(self, user_id: str = "default_user"):
+        """获取用户知识图谱数据"""
+        driver = self.router.require_driver(user_id)
+            
+        try:
+            with driver.session() as session:
+                return {
+                    "nodes": list(self._iter_graph_nodes(session)),
+                    "edges": list(self._iter_graph_edges(session))
+                }
+        except Exception as e:
+            print(f"图谱查询错误: {e}")
+            raise HTTPException(status_code=500, detail=f"获取图谱失败: {str(e)}")
+
+    def stream_user_knowledge_graph(self, user_id: str = "default_user"):
+        """以JSON字节流形式输出图谱，边读取Neo4j结果边写出，内存占用与图谱大小无关"""
+        driver = self.router.require_driver(user_id)
+
+        def batches(items):
+            # StreamingResponse 在线程池中迭代同步生成器，每次 yield 切换一次线程，按批输出
+            chunk = []
+            for index, item in enumerate(items):
+                chunk.append((b"," if index else b"") + orjson.dumps(item))
+                if len(chunk) >= self.STREAM_BATCH_ITEMS:
+                    yield b"".join(chunk)
+                    chunk = []
+            if chunk:
+                yield b"".join(chunk)
+
+        def generate():
+            with driver.session() as session:
+                yield b'{"success":true,"user_id":' + orjson.dumps(user_id) + b',"graph":{"nodes":['
+                yield from batches(self._iter_graph_nodes(session))
+                yield b'],"edges":['
+                yield from batches(self._iter_graph_edges(session))
+                yield b"]}}"
+
+        return generate()
+
+graph_builder = KnowledgeGraphBuilder(storage_router)
+
+# 用户数据在分片间迁移时复制的MongoDB集合
+USER_COLLECTIONS = ["conversations", "extractions", "health_events", "health_profiles", "profile_state"]
+RELATION_TYPE_PATTERN = re.compile(r"^[A-Z_]+$")
+
+# 分片迁移服务
+class ShardMigrator:
+    """在线迁移用户的对话、提取结果、时间线事件、健康档案及其图谱版本和图谱子图到另一个分片
+
+    流程：复制 -> 切换路由 -> 等待各进程目录缓存过期 -> 追平迁移期间的写入 -> 删除源分片数据。
+    复制按 _id/MERGE 写入，中断后重新执行是安全的。
+    """
+    BATCH_SIZE = 1000
+    CATCH_UP_ROUNDS = 10
+    CATCH_UP_SETTLE_SECONDS = 1.0
+
+    def __init__(self, router: ShardRouter):
+        self.router = router
+
+    @staticmethod
+    def user_filter(user_id: str) -> dict:
+        # 早期数据没有 user_id 字段，均属于 default_user
+        if user_id == "default_user":
+            return {"$or": [{"user_id": user_id}, {"user_id": {"$exists": False}}]}
+        return {"user_id": user_id}
+
+    @staticmethod
+    def _copy_operation(name: str, doc: dict):
+        if name == "profile_state":
+            # 切换路由后目标分片可能已记录新的图谱变化，按用户合并并保留较大的图谱版本
+            return UpdateOne(
+                {"user_id": doc["user_id"]},
+                {"$max": {"graph_version": doc.get("graph_version", 0)},
+                 "$setOnInsert": {"graph_updated_at": doc.get("graph_updated_at")}},
+                upsert=True
+            )
+        return ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+
+    @staticmethod
+    def _bulk_write(collection, batch: list):
+        try:
+            collection.bulk_write(batch, ordered=False)
+        except BulkWriteError as e:
+            # 目标分片已生成同一版本号的健康档案时保留目标分片的档案
+            if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+    def _copy_documents(self, source_db, target_db, user_id: str) -> dict:
+        copied = {}
+        for name in USER_COLLECTIONS:
+            copied[name] = 0
+            batch = []
+            for doc in source_db[name].find(self.user_filter(user_id)).batch_size(self.BATCH_SIZE):
+                batch.append(self._copy_operation(name, doc))
+                if len(batch) >= self.BATCH_SIZE:
+                    self._bulk_write(target_db[name], batch)
+                    copied[name] += len(batch)
+                    batch = []
+            if batch:
+                self._bulk_write(target_db[name], batch)
+                copied[name] += len(batch)
+        return copied
+
+    @staticmethod
+    def session_ids(db, user_id: str) -> list:
+        """用户全部会话ID，图谱中的实体和实体间关系按这些会话的溯源标签归属到用户"""
+        return [
+            doc["session_id"]
+            for doc in db.conversations.find(ShardMigrator.user_filter(user_id), {"session_id": 1})
+        ]
+
+    # 读取用户子图（参数 $user_id 和 $session_ids）：用户到实体的关系、溯源标签来自用户会话的实体和实体间关系。
+    # 实体可能被多个用户共享，只导出属于该用户会话的溯源标签；早期没有溯源标签的数据按 session_id 属性归属
+    LINEAGE_MATCH = "(any(tag IN coalesce({var}.lineage, []) WHERE split(tag, '@')[0] IN $session_ids) OR ({var}.lineage IS NULL AND {var}.{session_field} IN $session_ids))"
+    USER_LINEAGE = "[tag IN coalesce({var}.lineage, []) WHERE split(tag, '@')[0] IN $session_ids]"
+    USER_EDGES_QUERY = f"""
+        MATCH (u:User {{user_id: $user_id}})-[r]->(e:Entity)
+        RETURN type(r) AS type, properties(r) AS props, e.name AS name, e.type AS entity_type,
+               e {{.*, lineage: {USER_LINEAGE.format(var="e")}}} AS entity_props
+    """
+    ENTITIES_QUERY = f"""
+        MATCH (e:Entity)
+        WHERE {LINEAGE_MATCH.format(var="e", session_field="source_session")}
+        RETURN e.name AS name, e.type AS type, e {{.*, lineage: {USER_LINEAGE.format(var="e")}}} AS props
+    """
+    ENTITY_EDGES_QUERY = f"""
+        MATCH (s:Entity)-[r:RELATION]->(t:Entity)
+        WHERE {LINEAGE_MATCH.format(var="r", session_field="session_id")}
+        RETURN s.name AS source_name, s.type AS source_type,
+               t.name AS target_name, t.type AS target_type,
+               r {{.*, lineage: {USER_LINEAGE.format(var="r")}}} AS props
+    """
+    # 已存在的实体/关系合并溯源标签，其余属性只在创建时写入
+    MERGE_LINEAGE = "coalesce({var}.lineage, []) + [t IN coalesce(item.{field}.lineage, []) WHERE NOT t IN coalesce({var}.lineage, [])]"
+
+    def _read_subgraph(self, driver, user_id: str, session_ids: list) -> dict:
+        params = {"user_id": user_id, "session_ids": session_ids}
+        with driver.session() as session:
+            user = session.run(
+                "MATCH (u:User {user_id: $user_id}) RETURN properties(u) AS props", user_id=user_id
+            ).single()
+            entities = [record.data() for record in session.run(self.ENTITIES_QUERY, **params)]
+            user_edges = [record.data() for record in session.run(self.USER_EDGES_QUERY, **params)]
+            entity_edges = [record.data() for record in session.run(self.ENTITY_EDGES_QUERY, **params)]
+        return {
+            "user": user["props"] if user else None,
+            "entities": entities,
+            "user_edges": user_edges,
+            "entity_edges": entity_edges
+        }
+
+    @classmethod
+    def write_entities(cls, tx, entities: list):
+        """批量写入实体（包括没有用户关系的检查、治疗等实体）"""
+        for offset in range(0, len(entities), cls.BATCH_SIZE):
+            tx.run(f"""
+                UNWIND $items AS item
+                MERGE (e:Entity {{name: item.name, type: item.type}})
+                ON CREATE SET e += item.props
+                SET e.lineage = {cls.MERGE_LINEAGE.format(var="e", field="props")}
+            """, items=entities[offset:offset + cls.BATCH_SIZE])
+
+    @classmethod
+    def write_user_edges(cls, tx, user_id: str, edges: list):
+        """批量写入用户到实体的关系（关系类型不能参数化，按类型分批）"""
+        edges_by_type = {}
+        for edge in edges:
+            edges_by_type.setdefault(edge["type"], []).append(edge)
+        for relation_type, typed_edges in edges_by_type.items():
+            if not RELATION_TYPE_PATTERN.match(relation_type):
+                continue
+            for offset in range(0, len(typed_edges), cls.BATCH_SIZE):
+                tx.run(f"""
+                    UNWIND $items AS item
+                    MATCH (u:User {{user_id: $user_id}})
+                    MERGE (e:Entity {{name: item.name, type: item.entity_type}})
+                    ON CREATE SET e += item.entity_props
+                    SET e.lineage = {cls.MERGE_LINEAGE.format(var="e", field="entity_props")}
+                    MERGE (u)-[r:{relation_type}]->(e)
+                    SET r += item.props
+                """, items=typed_edges[offset:offset + cls.BATCH_SIZE], user_id=user_id)
+
+    @classmethod
+    def write_entity_edges(cls, tx, edges: list):
+        """批量写入实体之间的关系"""
+        for offset in range(0, len(edges), cls.BATCH_SIZE):
+            tx.run(f"""
+                UNWIND $items AS item
+                MATCH (s:Entity {{name: item.source_name, type: item.source_type}})
+                MATCH (t:Entity {{name: item.target_name, type: item.target_type}})
+                MERGE (s)-[r:RELATION {{type: item.props.type}}]->(t)
+                ON CREATE SET r += item.props
+                SET r.lineage = {cls.MERGE_LINEAGE.format(var="r", field="props")}
+            """, items=edges[offset:offset + cls.BATCH_SIZE])
+
+    def _write_subgraph(self, driver, user_id: str, subgraph: dict) -> dict:
+        if subgraph["user"] is None:
+            return {"entities": 0, "user_edges": 0, "entity_edges": 0}
+
+        def write(tx):
+            tx.run("MERGE (u:User {user_id: $user_id}) SET u += $props", user_id=user_id, props=subgraph["user"])
+            self.write_entities(tx, subgraph["entities"])
+            self.write_user_edges(tx, user_id, subgraph["user_edges"])
+            self.write_entity_edges(tx, subgraph["entity_edges"])
+
+        with driver.session() as session:
+            session.execute_write(write)
+        return {key: len(subgraph[key]) for key in ("entities", "user_edges", "entity_edges")}
+
+    def _copy_user(self, source: StorageShard, target: StorageShard, user_id: str) -> tuple:
+        copied = self._copy_documents(source.db, target.db, user_id)
+        session_ids = self.session_ids(source.db, user_id)
+        graph = self._write_subgraph(target.driver, user_id, self._read_subgraph(source.driver, user_id, session_ids))
+        return copied, graph
+
+    def _fingerprint(self, db, user_id: str) -> str:
+        """用户在某个分片上全部文档的摘要，用于判断追平期间是否还有新写入"""
+        digest = hashlib.md5()
+        for name in USER_COLLECTIONS:
+            for doc in db[name].find(self.user_filter(user_id)).sort("_id", 1).batch_size(self.BATCH_SIZE):
+                digest.update(json_util.dumps(doc).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _delete_source(self, shard: StorageShard, user_id: str):
+        session_ids = self.session_ids(shard.db, user_id)
+        for name in USER_COLLECTIONS:
+            shard.db[name].delete_many(self.user_filter(user_id))
+
+        def delete(tx):
+            params = {"user_id": user_id, "session_ids": session_ids}
+            # 删除用户节点及其关系，没有溯源标签的早期实体成为孤立节点时一并删除
+            tx.run("""
+                MATCH (u:User {user_id: $user_id})
+                OPTIONAL MATCH (u)-->(e:Entity)
+                WITH u, collect(DISTINCT e) AS entities
+                DETACH DELETE u
+                WITH entities
+                UNWIND entities AS e
+                WITH e WHERE e.lineage IS NULL AND NOT (e)--()
+                DELETE e
+            """, **params)
+            # 实体间关系和实体去掉该用户会话的溯源标签，没有其他来源时删除
+            tx.run(f"""
+                MATCH (:Entity)-[r:RELATION]->(:Entity)
+                WHERE {self.LINEAGE_MATCH.format(var="r", session_field="session_id")}
+                SET r.lineage = [tag IN coalesce(r.lineage, []) WHERE NOT split(tag, '@')[0] IN $session_ids]
+                WITH r WHERE size(r.lineage) = 0
+                DELETE r
+            """, **params)
+            tx.run(f"""
+                MATCH (e:Entity)
+                WHERE {self.LINEAGE_MATCH.format(var="e", session_field="source_session")}
+                SET e.lineage = [tag IN coalesce(e.lineage, []) WHERE NOT split(tag, '@')[0] IN $session_ids]
+                WITH e WHERE size(e.lineage) = 0 AND NOT (e)--()
+                DELETE e
+            """, **params)
+
+        with shard.driver.session() as session:
+            session.execute_write(delete)
+
+    def migrate_user(self, user_id: str, target_name: str, wait_seconds: int = None) -> dict:
+        """把用户迁移到目标分片"""
+        if target_name not in self.router.shards:
+            raise HTTPException(status_code=404, detail=f"分片不存在: {target_name}")
+        source = self.router.shard_for(user_id)
+        target = self.router.shards[target_name]
+        # 上次迁移到目标分片后未能删除源数据时，从原来的源分片继续
+        entry = self.router.directory.find_one({"user_id": user_id}) if self.router.directory is not None else None
+        if entry and source.name == target.name and entry.get("migrating_from") in self.router.shards:
+            source = self.router.shards[entry["migrating_from"]]
+        if source.name == target.name:
+            return {"user_id": user_id, "moved": False, "shard": source.name}
+        for shard in (source, target):
+            if shard.db is None or not shard.driver:
+                raise HTTPException(status_code=500, detail=f"分片 {shard.name} 连接失败")
+
+        print(f"开始迁移用户 {user_id}: {source.name} -> {target.name}")
+        copied, graph = self._copy_user(source, target, user_id)
+
+        # 切换路由后等待其他进程的目录缓存过期，再追平期间写入源分片的数据；
+        # 路由切换前开始的请求可能在等待之后才写入源分片，因此重复追平直到源分片不再变化
+        self.router.set_shard(user_id, target.name, migrating_from=source.name)
+        time.sleep(self.router.directory_ttl if wait_seconds is None else wait_seconds)
+        for _ in range(self.CATCH_UP_ROUNDS):
+            fingerprint = self._fingerprint(source.db, user_id)
+            self._copy_user(source, target, user_id)
+            time.sleep(self.CATCH_UP_SETTLE_SECONDS)
+            if self._fingerprint(source.db, user_id) == fingerprint:
+                break
+        else:
+            raise HTTPException(
+                status_code=409,
+                detail=f"用户 {user_id} 在源分片 {source.name} 上仍有写入，已切换到 {target.name} 但未删除源数据，请稍后重新执行迁移"
+            )
+
+        self._delete_source(source, user_id)
+        self.router.set_shard(user_id, target.name)
+        # 迁移期间目标分片上的图谱变化可能被复制来的版本号覆盖，迁移完成后再递增一次并安排重新生成档案
+        target.db.profile_state.update_one(
+            {"user_id": user_id},
+            {"$inc": {"graph_version": 1}, "$set": {"graph_updated_at": datetime.now().isoformat()}},
+            upsert=True
+        )
+        health_profile_service.schedule(user_id)
+        print(f"用户 {user_id} 迁移完成")
+        return {
+            "user_id": user_id,
+            "moved": True,
+            "source": source.name,
+            "target": target.name,
+            "documents": copied,
+            "graph": graph
+        }
+
+    def sync_directory(self) -> int:
+        """把各分片中尚未登记的用户登记到分片目录（增加分片前执行，避免已有用户被哈希环重新路由）"""
+        registered = 0
+        if self.router.directory is None:
+            return registered
+        for shard in self.router.shards.values():
+            if shard.db is None:
+                continue
+            users = set(shard.db.conversations.distinct("user_id"))
+            if shard.db.conversations.find_one({"user_id": {"$exists": False}}):
+                users.add("default_user")
+            for user_id in users:
+                result = self.router.directory.update_one(
+                    {"user_id": user_id},
+                    {"$setOnInsert": {"shard": shard.name, "assigned_at": datetime.now().isoformat()}},
+                    upsert=True
+                )
+                registered += 1 if result.upserted_id else 0
+        return registered
+
+    def rebalance(self, apply: bool = False) -> dict:
+        """把所在分片与哈希环分片不一致的用户迁移到哈希环分片（apply=False 时只返回计划）"""
+        registered = self.sync_directory()
+        plan = []
+        if self.router.directory is not None:
+            for entry in self.router.directory.find({}, {"user_id": 1, "shard": 1}):
+                ring_shard = self.router.ring_shard(entry["user_id"]).name
+                if entry["shard"] != ring_shard:
+                    plan.append({"user_id": entry["user_id"], "source": entry["shard"], "target": ring_shard})
+
+        results = []
+        if apply:
+            for move in plan:
+                try:
+                    results.append(self.migrate_user(move["user_id"], move["target"]))
+                except Exception as e:
+                    print(f"迁移用户失败 {move['user_id']}: {e}")
+                    results.append({"user_id": move["user_id"], "moved": False, "error": str(e)})
+
+        return {"registered": registered, "plan": plan, "results": results}
+
+shard_migrator = ShardMigrator(storage_router)
+
+# 健康记录归档格式
+ARCHIVE_FORMAT = "health-record/1"
+ARCHIVE_CHUNK_SIZE = 1000
+
+# 健康记录导出/导入服务
+class HealthRecordArchive:
+    """用户完整健康记录（对话、提取结果、时间线、档案及其图谱版本和图谱子图）的导出/导入
+
+    归档为gzip压缩的分块NDJSON：首行是头信息，之后每行是同一类型的一批记录，MongoDB文档
+    使用扩展JSON保留ObjectId和时间类型。导出边读游标边写出，不在内存中保留完整数据；
+    导入按块批量写入，每块完成后记录检查点，中断后重新导入同一归档会从检查点继续。
+    """
+
+    def __init__(self, router: ShardRouter):
+        self.router = router
+
+    @classmethod
+    def _encode_graph_value(cls, value):
+        if isinstance(value, Neo4jDateTime):
+            return {"__neo4j_datetime__": value.iso_format()}
+        if isinstance(value, list):
+            return [cls._encode_graph_value(item) for item in value]
+        if isinstance(value, dict):
+            return {key: cls._encode_graph_value(item) for key, item in value.items()}
+        return value
+
+    @classmethod
+    def _decode_graph_value(cls, value):
+        if isinstance(value, dict):
+            if "__neo4j_datetime__" in value:
+                return Neo4jDateTime.from_iso_format(value["__neo4j_datetime__"])
+            return {key: cls._decode_graph_value(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [cls._decode_graph_value(item) for item in value]
+        return value
+
+    @staticmethod
+    def _line(record: dict) -> bytes:
+        return (json_util.dumps(record, json_options=json_util.RELAXED_JSON_OPTIONS) + "\n").encode("utf-8")
+
+    @staticmethod
+    def _chunks(iterable, size: int = ARCHIVE_CHUNK_SIZE):
+        chunk = []
+        for item in iterable:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def export_lines(self, user_id: str):
+        """逐行生成归档内容（未压缩）"""
+        shard = self.router.shard_for(user_id)
+        if shard.db is None or not shard.driver:
+            raise HTTPException(status_code=500, detail=f"分片 {shard.name} 连接失败")
+
+        yield self._line({
+            "type": "header",
+            "format": ARCHIVE_FORMAT,
+            "export_id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "exported_at": datetime.now().isoformat()
+        })
+
+        for name in USER_COLLECTIONS:
+            cursor = shard.db[name].find(ShardMigrator.user_filter(user_id)).batch_size(ARCHIVE_CHUNK_SIZE)
+            for chunk in self._chunks(cursor):
+                yield self._line({"type": name, "docs": chunk})
+
+        params = {"user_id": user_id, "session_ids": ShardMigrator.session_ids(shard.db, user_id)}
+        with shard.driver.session() as session:
+            user = session.run(
+                "MATCH (u:User {user_id: $user_id}) RETURN properties(u) AS props", user_id=user_id
+            ).single()
+            if user is None:
+                return
+            yield self._line({"type": "user", "props": self._encode_graph_value(user["props"])})
+
+            for record_type, query in [("entities", ShardMigrator.ENTITIES_QUERY),
+                                       ("user_edges", ShardMigrator.USER_EDGES_QUERY),
+                                       ("entity_edges", ShardMigrator.ENTITY_EDGES_QUERY)]:
+                records = (self._encode_graph_value(record.data()) for record in session.run(query, **params))
+                for chunk in self._chunks(records):
+                    yield self._line({"type": record_type, "items": chunk})
+
+    def export_gzip(self, user_id: str):
+        """生成gzip压缩的归档字节流"""
+        compressor = zlib.compressobj(wbits=31)
+        for line in self.export_lines(user_id):
+            data = compressor.compress(line)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def export_to_file(self, user_id: str, path: str) -> str:
+        with open(path, "wb") as f:
+            for data in self.export_gzip(user_id):
+                f.write(data)
+        return path
+
+    def _import_chunk(self, shard: StorageShard, user_id: str, record: dict):
+        record_type = record["type"]
+        if record_type in USER_COLLECTIONS:
+            try:
+                shard.db[record_type].insert_many(record["docs"], ordered=False)
+            except BulkWriteError as e:
+                # 从检查点恢复时，中断的那一块可能已部分写入，忽略重复的 _id
+                if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+            if record_type == "conversations":
+                for doc in record["docs"]:
+                    search_index.index_document(doc["session_id"], user_id, doc.get("content", ""))
+        elif record_type == "user":
+            with shard.driver.session() as session:
+                session.run(
+                    "MERGE (u:User {user_id: $user_id}) SET u += $props",
+                    user_id=user_id, props=self._decode_graph_value(record["props"])
+                ).consume()
+        elif record_type == "entities":
+            with shard.driver.session() as session:
+                session.execute_write(ShardMigrator.write_entities, self._decode_graph_value(record["items"]))
+        elif record_type == "user_edges":
+            with shard.driver.session() as session:
+                session.execute_write(ShardMigrator.write_user_edges, user_id, self._decode_graph_value(record["items"]))
+        elif record_type == "entity_edges":
+            with shard.driver.session() as session:
+                session.execute_write(ShardMigrator.write_entity_edges, self._decode_graph_value(record["items"]))
+
+    def import_file(self, path: str) -> dict:
+        """导入归档文件（支持断点续传）"""
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json_util.loads(f.readline())
+            if header.get("type") != "header" or header.get("format") != ARCHIVE_FORMAT:
+                raise HTTPException(status_code=400, detail="无效的归档文件")
+
+            user_id = header["user_id"]
+            shard = self.router.assign(user_id)
+            if shard.db is None or not shard.driver:
+                raise HTTPException(status_code=500, detail=f"分片 {shard.name} 连接失败")
+
+            checkpoint = shard.db.import_checkpoints.find_one({"_id": header["export_id"]}) or {}
+            chunks_done = checkpoint.get("chunks_done", 0)
+            if checkpoint.get("completed"):
+                return {"user_id": user_id, "export_id": header["export_id"], "chunks": chunks_done, "resumed_from": chunks_done}
+
+            counts = {}
+            index = 0
+            for index, line in enumerate(f, start=1):
+                if index <= chunks_done:
+                    continue
+                record = json_util.loads(line)
+                self._import_chunk(shard, user_id, record)
+                size = len(record.get("docs") or record.get("items") or [record])
+                counts[record["type"]] = counts.get(record["type"], 0) + size
+                shard.db.import_checkpoints.update_one(
+                    {"_id": header["export_id"]},
+                    {"$set": {"user_id": user_id, "chunks_done": index, "updated_at": datetime.now().isoformat()}},
+                    upsert=True
+                )
+
+            # 导入的用户属性带有导出时的 last_updated，重新标记为刚更新，增量共现分析才会纳入该用户；
+            # 归档中的图谱版本可能与本分片已有的不一致，标记图谱变化以重新生成健康档案
+            with shard.driver.session() as session:
+                session.run(
+                    "MATCH (u:User {user_id: $user_id}) SET u.last_updated = datetime()", user_id=user_id
+                ).consume()
+            health_profile_service.mark_graph_changed(user_id)
+
+            shard.db.import_checkpoints.update_one(
+                {"_id": header["export_id"]},
+                {"$set": {"user_id": user_id, "chunks_done": index, "completed": True, "updated_at": datetime.now().isoformat()}},
+                upsert=True
+            )
+
+        print(f"导入完成 {user_id}: {counts}")
+        return {
+            "user_id": user_id,
+            "export_id": header["export_id"],
+            "chunks": index,
+            "resumed_from": chunks_done,
+            "imported": counts
+        }
+
+health_record_archive = HealthRecordArchive(storage_router)
+
+# 跨用户共现分析配置
+ANALYTICS_MIN_SUPPORT = int(os.getenv("ANALYTICS_MIN_SUPPORT", "2"))   # 至少多少个用户同时出现才计算关联
+ANALYTICS_TOP_K = int(os.getenv("ANALYTICS_TOP_K", "20"))              # 每个实体保存的关联实体数量
+ANALYTICS_ENRICH_PROMPTS = os.getenv("ANALYTICS_ENRICH_PROMPTS", "false").lower() == "true"
+# 计算关联的实体类型组合：症状-疾病、药物-疾病、药物-症状
+ANALYTICS_TYPE_PAIRS = [("症状", "疾病"), ("药物", "疾病"), ("药物", "症状")]
+
+# 跨用户共现分析服务
+class CooccurrenceAnalytics:
+    """把 User->Entity 关系导出为稀疏矩阵，向量化计算实体共现次数和提升度（lift）
+
+    共现矩阵 C = XᵀX（X 为 用户×实体 的0/1矩阵）。增量运行时只导出上次运行后图谱有变化的用户，
+    用 C - X_oldᵀX_old + X_newᵀX_new 更新。矩阵和实体表存入默认分片的GridFS，
+    每个实体的关联结果存入 analytics_related 集合，按实体名称直接查询。
+    """
+    STATE_ID = "cooccurrence"
+
+    def __init__(self, router: ShardRouter):
+        self.router = router
+
+    @property
+    def store(self):
+        store_db = self.router.default.db
+        if store_db is None:
+            raise HTTPException(status_code=500, detail="数据库连接失败")
+        return store_db
+
+    def _export_user_entities(self, since: str = None) -> dict:
+        """从各分片导出用户的实体集合（since 不为空时只导出之后有变化的用户）"""
+        users = {}
+        for shard in self.router.shards.values():
+            if not shard.driver:
+                continue
+            with shard.driver.session() as session:
+                result = session.run("""
+                    MATCH (u:User)
+                    WHERE $since IS NULL OR u.last_updated >= datetime($since)
+                    OPTIONAL MATCH (u)-[r]->(e:Entity)
+                    WHERE type(r) IN $relation_types
+                    RETURN u.user_id AS user_id, collect(DISTINCT e.name + '|' + e.type) AS entities
+                """, since=since, relation_types=list(USER_RELATION_TYPES.values()))
+                for record in result:
+                    users[record["user_id"]] = record["entities"]
+        return users
+
+    def _load_state(self):
+        state = self.store.analytics_state.find_one({"_id": self.STATE_ID})
+        if not state:
+            return None, sparse.csr_matrix((0, 0), dtype=np.int64), [], 0
+        with gridfs.GridFS(self.store, collection="analytics").get(state["file_id"]) as stored:
+            arrays = np.load(io.BytesIO(stored.read()))
+            matrix = sparse.csr_matrix(
+                (arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(arrays["shape"])
+            )
+            vocabulary = arrays["vocabulary"].tolist()
+        return state, matrix, vocabulary, state["user_count"]
+
+    def _save_state(self, state, matrix, vocabulary: list, user_count: int, started_at: str):
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+            shape=np.array(matrix.shape), vocabulary=np.array(vocabulary, dtype=str)
+        )
+        fs = gridfs.GridFS(self.store, collection="analytics")
+        file_id = fs.put(buffer.getvalue(), filename="cooccurrence.npz")
+        self.store.analytics_state.replace_one({"_id": self.STATE_ID}, {
+            "_id": self.STATE_ID,
+            "file_id": file_id,
+            "user_count": user_count,
+            "entity_count": len(vocabulary),
+            "last_run": started_at
+        }, upsert=True)
+        if state:
+            fs.delete(state["file_id"])
+
+    @staticmethod
+    def _user_matrix(entity_lists: list, index: dict, size: int):
+        """用户×实体 0/1 稀疏矩阵"""
+        rows = np.fromiter(
+            (row for row, entities in enumerate(entity_lists) for _ in entities), dtype=np.int64
+        )
+        cols = np.fromiter(
+            (index[entity] for entities in entity_lists for entity in entities), dtype=np.int64
+        )
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int64), (rows, cols)), shape=(len(entity_lists), size)
+        )
+
+    def _related_documents(self, matrix, vocabulary: list, user_count: int, run_id: str):
+        """向量化计算所有实体对的支持度、提升度和置信度，每个实体取提升度最高的 TOP_K 个"""
+        counts = matrix.diagonal().astype(np.float64)
+        pairs = matrix.tocoo()
+        names = np.array([key.rsplit("|", 1)[0] for key in vocabulary])
+        types = np.array([key.rsplit("|", 1)[1] for key in vocabulary])
+
+        # 允许的类型组合（双向）
+        type_codes, type_index = np.unique(types, return_inverse=True)
+        allowed = np.zeros((len(type_codes), len(type_codes)), dtype=bool)
+        code_of = {value: code for code, value in enumerate(type_codes)}
+        for first, second in ANALYTICS_TYPE_PAIRS:
+            if first in code_of and second in code_of:
+                allowed[code_of[first], code_of[second]] = True
+                allowed[code_of[second], code_of[first]] = True
+
+        mask = (pairs.row != pairs.col) & (pairs.data >= ANALYTICS_MIN_SUPPORT)
+        mask &= allowed[type_index[pairs.row], type_index[pairs.col]]
+        rows, cols, support = pairs.row[mask], pairs.col[mask], pairs.data[mask].astype(np.float64)
+
+        lift = support * user_count / (counts[rows] * counts[cols])
+        confidence = support / counts[rows]
+
+        # 按实体分组，组内按提升度降序
+        order = np.lexsort((-lift, rows))
+        rows, cols, support, lift, confidence = rows[order], cols[order], support[order], lift[order], confidence[order]
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]]) if len(rows) else np.array([], dtype=np.int64)
+        ends = np.r_[starts[1:], len(rows)]
+
+        for start, end in zip(starts, ends):
+            end = min(end, start + ANALYTICS_TOP_K)
+            entity = rows[start]
+            yield {
+                "_id": vocabulary[entity],
+                "name": str(names[entity]),
+                "type": str(types[entity]),
+                "support": int(counts[entity]),
+                "user_count": user_count,
+                "related": [
+                    {
+                        "name": str(names[col]),
+                        "type": str(types[col]),
+                        "support": int(sup),
+                        "lift": round(float(lft), 4),
+                        "confidence": round(float(conf), 4)
+                    }
+                    for col, sup, lft, conf in zip(cols[start:end], support[start:end],
+                                                   lift[start:end], confidence[start:end])
+                ],
+                "run_id": run_id
+            }
+
+    def run(self, full: bool = False) -> dict:
+        """运行分析任务（默认增量，只处理上次运行后有变化的用户）"""
+        started_at = datetime.now(timezone.utc).isoformat()
+        state, matrix, vocabulary, user_count = self._load_state()
+        stored_state = state
+        if full or state is None:
+            state, matrix, vocabulary, user_count = None, sparse.csr_matrix((0, 0), dtype=np.int64), [], 0
+            self.store.analytics_user_entities.delete_many({})
+
+        touched = self._export_user_entities(None if state is None else state["last_run"])
+        if not touched and state is not None:
+            return {"touched_users": 0, "user_count": user_count, "entity_count": len(vocabulary)}
+
+        user_ids = list(touched)
+        previous = {}
+        for offset in range(0, len(user_ids), 10000):
+            for doc in self.store.analytics_user_entities.find({"user_id": {"$in": user_ids[offset:offset + 10000]}}):
+                previous[doc["user_id"]] = doc["entities"]
+        old_lists = [previous.get(user_id, []) for user_id in user_ids]
+        new_lists = [touched[user_id] for user_id in user_ids]
+
+        # 扩充实体表
+        index = {entity: position for position, entity in enumerate(vocabulary)}
+        for entities in new_lists:
+            for entity in entities:
+                if entity not in index:
+                    index[entity] = len(vocabulary)
+                    vocabulary.append(entity)
+        size = len(vocabulary)
+        matrix = matrix.tolil()
+        matrix.resize((size, size))
+        matrix = matrix.tocsr()
+
+        old_matrix = self._user_matrix(old_lists, index, size)
+        new_matrix = self._user_matrix(new_lists, index, size)
+        matrix = (matrix - old_matrix.T @ old_matrix + new_matrix.T @ new_matrix).tocsr()
+        matrix.eliminate_zeros()
+        user_count += sum(1 for entities in new_lists if entities) - sum(1 for entities in old_lists if entities)
+
+        # 保存用户实体集合，供下次增量计算
+        operations = [
+            ReplaceOne({"user_id": user_id}, {"user_id": user_id, "entities": entities}, upsert=True)
+            for user_id, entities in zip(user_ids, new_lists)
+        ]
+        for offset in range(0, len(operations), 1000):
+            self.store.analytics_user_entities.bulk_write(operations[offset:offset + 1000], ordered=False)
+
+        # 重写关联结果（用户总数变化会影响所有提升度）
+        run_id = str(uuid.uuid4())
+        batch = []
+        for doc in self._related_documents(matrix, vocabulary, user_count, run_id):
+            batch.append(ReplaceOne({"_id": doc["_id"]}, doc, upsert=True))
+            if len(batch) >= 1000:
+                self.store.analytics_related.bulk_write(batch, ordered=False)
+                batch = []
+        if batch:
+            self.store.analytics_related.bulk_write(batch, ordered=False)
+        self.store.analytics_related.delete_many({"run_id": {"$ne": run_id}})
+
+        self._save_state(stored_state, matrix, vocabulary, user_count, started_at)
+        print(f"共现分析完成：处理 {len(user_ids)} 个用户，共 {user_count} 个用户、{size} 个实体")
+        return {"touched_users": len(user_ids), "user_count": user_count, "entity_count": size}
+
+    def related(self, entity: str, limit: int = 10) -> list:
+        """查询与实体关联的其他实体（按实体名称，可能对应多个类型）"""
+        return [
+            {**doc, "related": doc["related"][:limit]}
+            for doc in self.store.analytics_related.find({"name": entity}, {"_id": 0, "run_id": 0})
+        ]
+
+    def format_related_for_llm(self, names: list, limit: int = 3) -> str:
+        """把用户主要症状/疾病的人群关联数据格式化为LLM可理解的文本"""
+        lines = []
+        for doc in self.store.analytics_related.find({"name": {"$in": names}}, {"_id": 0, "run_id": 0}):
+            related = "、".join(
+                f"{item['name']}({item['type']}, 提升度 {item['lift']:.1f})" for item in doc["related"][:limit]
+            )
+            if related:
+                lines.append(f"- {doc['name']}：常与 {related} 同时出现")
+        if not lines:
+            return ""
+        return "人群关联数据（基于所有用户的共现统计，仅供参考）：\n" + "\n".join(lines) + "\n"
+
+cooccurrence_analytics = CooccurrenceAnalytics(storage_router)
+
+# 全文检索服务
+class SearchIndex:
+    """对话内容和提取实体名称的内存倒排索引
+
+    中文按字符二元组切分（文档同时索引单字，单字查询也能命中），英文和数字按单词切分，使用BM25排序。
+    启动时在后台线程从MongoDB构建，/upload 和 /extract 时增量更新（每个进程各自维护一份索引）。
+    倒排表按词号存放为按文档号排序的 array（文档号4字节 + 词频2字节），不为每条记录创建Python对象。
+    """
+    TOKEN_PATTERN = re.compile(r"[\u4e00-\u9fff]+|[a-z0-9]+")
+    K1 = 1.5
+    B = 0.75
+    MAX_FREQUENCY = 65535
+
+    def __init__(self):
+        # 导入归档时在线程池中更新索引，与线程池中的检索并发，读写都需要加锁
+        self.lock = threading.RLock()
+        # 重建期间的增量更新，重建完成后在新索引上重放
+        self.pending = None
+        self._reset()
+
+    def _reset(self):
+        self.terms = {}                 # 词 -> 词号
+        self.postings = []              # 词号 -> (文档号 array('I'), 词频 array('H'))，文档号升序
+        self.doc_ids = {}               # session_id -> 文档号
+        self.session_ids = []           # 文档号 -> session_id，删除后为None
+        self.doc_users = []             # 文档号 -> user_id
+        self.doc_terms = []             # 文档号 -> 词号 array('I')，删除文档时使用
+        self.doc_lengths = array("I")   # 文档号 -> 文档长度
+        self.free_ids = []              # 已删除可复用的文档号
+        self.user_docs = {}             # user_id -> 文档号集合
+        self.total_length = 0
+        self.doc_count = 0
+
+    @classmethod
+    def tokenize(cls, text: str, unigrams: bool = False) -> list:
+        """中文字符二元组 + 英文/数字单词；unigrams=True 时（建立索引）同时输出中文单字"""
+        tokens = []
+        for run in cls.TOKEN_PATTERN.findall((text or "").lower()):
+            if run[0].isascii():
+                tokens.append(run)
+            elif len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+                if unigrams:
+                    tokens.extend(run)
+        return tokens
+
+    def _remove(self, session_id: str):
+        doc_id = self.doc_ids.pop(session_id, None)
+        if doc_id is None:
+            return
+        for term_id in self.doc_terms[doc_id]:
+            ids, frequencies = self.postings[term_id]
+            position = bisect.bisect_left(ids, doc_id)
+            del ids[position]
+            del frequencies[position]
+        user_id = self.doc_users[doc_id]
+        user_docs = self.user_docs[user_id]
+        user_docs.discard(doc_id)
+        if not user_docs:
+            del self.user_docs[user_id]
+        self.total_length -= self.doc_lengths[doc_id]
+        self.session_ids[doc_id] = self.doc_users[doc_id] = self.doc_terms[doc_id] = None
+        self.free_ids.append(doc_id)
+        self.doc_count -= 1
+
+    def remove_document(self, session_id: str):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(("remove_document", (session_id,)))
+            self._remove(session_id)
+
+    def index_document(self, session_id: str, user_id: str, content: str, entity_names: list = None):
+        """添加或更新一个会话的索引"""
+        tokens = self.tokenize(content, unigrams=True)
+        for name in entity_names or []:
+            tokens.extend(self.tokenize(name, unigrams=True))
+
+        frequencies = {}
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(("index_document", (session_id, user_id, content, entity_names)))
+            self._remove(session_id)
+
+            if self.free_ids:
+                doc_id = self.free_ids.pop()
+                self.session_ids[doc_id] = session_id
+                self.doc_users[doc_id] = user_id
+                self.doc_lengths[doc_id] = len(tokens)
+            else:
+                doc_id = len(self.session_ids)
+                self.session_ids.append(session_id)
+                self.doc_users.append(user_id)
+                self.doc_terms.append(None)
+                self.doc_lengths.append(len(tokens))
+
+            term_ids = array("I")
+            for term, frequency in frequencies.items():
+                term_id = self.terms.get(term)
+                if term_id is None:
+                    term_id = self.terms[term] = len(self.postings)
+                    self.postings.append((array("I"), array("H")))
+                ids, term_frequencies = self.postings[term_id]
+                frequency = min(frequency, self.MAX_FREQUENCY)
+                if not ids or ids[-1] < doc_id:
+                    ids.append(doc_id)
+                    term_frequencies.append(frequency)
+                else:
+                    # 复用的文档号插入到有序位置
+                    position = bisect.bisect_left(ids, doc_id)
+                    ids.insert(position, doc_id)
+                    term_frequencies.insert(position, frequency)
+                term_ids.append(term_id)
+
+            self.doc_terms[doc_id] = term_ids
+            self.doc_ids[session_id] = doc_id
+            self.user_docs.setdefault(user_id, set()).add(doc_id)
+            self.total_length += len(tokens)
+            self.doc_count += 1
+
+    def _score_all(self, matches: list, average_length: float, count: int) -> tuple:
+        """不按用户过滤时命中文档很多，用numpy按整条倒排表计算BM25分数"""
+        lengths = np.array(self.doc_lengths, dtype=np.float64)
+        scores = np.zeros(len(lengths))
+        for idf, ids, frequencies in matches:
+            doc_ids = np.array(ids, dtype=np.int64)
+            frequency = np.array(frequencies, dtype=np.float64)
+            norm = self.K1 * (1 - self.B + self.B * lengths[doc_ids] / average_length)
+            scores[doc_ids] += idf * frequency * (self.K1 + 1) / (frequency + norm)
+
+        total = int(np.count_nonzero(scores))
+        count = min(count, total)
+        if not count:
+            return [], total
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top])]
+        return [(int(doc_id), float(scores[doc_id])) for doc_id in top], total
+
+    def search(self, query: str, user_id: str = None, limit: int = 20, offset: int = 0) -> dict:
+        """BM25检索，返回 (session_id, user_id, 分数) 列表和命中总数"""
+        terms = set(self.tokenize(query))
+        with self.lock:
+            if not terms or not self.doc_count:
+                return {"total": 0, "hits": []}
+
+            average_length = self.total_length / self.doc_count
+            matches = []
+            for term in terms:
+                term_id = self.terms.get(term)
+                if term_id is None:
+                    continue
+                ids, frequencies = self.postings[term_id]
+                if ids:
+                    idf = math.log(1 + (self.doc_count - len(ids) + 0.5) / (len(ids) + 0.5))
+                    matches.append((idf, ids, frequencies))
+
+            if not user_id:
+                top, total = self._score_all(matches, average_length, offset + limit)
+                top = top[offset:]
+            else:
+                allowed = self.user_docs.get(user_id, set())
+                scores = {}
+                for idf, ids, frequencies in matches:
+                    # 按用户过滤时遍历较小的集合，在有序倒排表中二分查找
+                    if len(allowed) < len(ids):
+                        candidates = []
+                        for doc_id in allowed:
+                            position = bisect.bisect_left(ids, doc_id)
+                            if position < len(ids) and ids[position] == doc_id:
+                                candidates.append((doc_id, frequencies[position]))
+                    else:
+                        candidates = ((doc_id, frequency) for doc_id, frequency in zip(ids, frequencies)
+                                      if doc_id in allowed)
+                    for doc_id, frequency in candidates:
+                        norm = self.K1 * (1 - self.B + self.B * self.doc_lengths[doc_id] / average_length)
+                        scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.K1 + 1) / (frequency + norm)
+                top = heapq.nlargest(offset + limit, scores.items(), key=lambda item: item[1])[offset:]
+                total = len(scores)
 
-@app.get("/health/profile/{user_id}")
-async def generate_health_profile(user_id: str = "default_user"):
-    """生成个人健康档案"""
-    try:
-        # 获取用户健康数据
-        health_data = health_analysis_service.get_user_health_summary(user_id)
-        
-        # 检查是否有数据
-        total_items = (len(health_data["symptoms"]) + len(health_data["diseases"]) + 
-                      len(health_data["medications"]) + len(health_data["treatments"]) + 
-                      len(health_data["tests"]))
-        
-        if total_items == 0:
+            return {
+                "total": total,
+                "hits": [(self.session_ids[doc_id], self.doc_users[doc_id], score) for doc_id, score in top]
+            }
+
+    def rebuild(self, router: ShardRouter):
+        """从各分片的MongoDB全量构建索引（流式读取游标）
+
+        在新的索引中构建，期间检索仍使用当前索引；构建期间的增量更新在新索引上重放后再替换。
+        """
+        fresh = SearchIndex()
+        with self.lock:
+            self.pending = []
+        try:
+            for shard in router.shards.values():
+                if shard.db is None:
+                    continue
+                entity_names = {}
+                for extraction in shard.db.extractions.find({}, {"session_id": 1, "entities.name": 1}):
+                    entity_names[extraction["session_id"]] = [
+                        entity.get("name", "") for entity in extraction.get("entities", [])
+                    ]
+                for conversation in shard.db.conversations.find({}, {"session_id": 1, "user_id": 1, "content": 1}):
+                    fresh.index_document(
+                        conversation["session_id"],
+                        conversation.get("user_id", "default_user"),
+                        conversation.get("content", ""),
+                        entity_names.get(conversation["session_id"])
+                    )
+
+            with self.lock:
+                for method, args in self.pending:
+                    getattr(fresh, method)(*args)
+                # 替换索引数据，保留本对象的锁
+                for name, value in vars(fresh).items():
+                    if name not in ("lock", "pending"):
+                        setattr(self, name, value)
+            print(f"检索索引构建完成，共 {self.doc_count} 个会话")
+        finally:
+            with self.lock:
+                self.pending = None
+
+search_index = SearchIndex()
+
+@app.on_event("startup")
+async def start_profile_scheduler():
+    health_profile_service.loop = asyncio.get_running_loop()
+
+@app.on_event("startup")
+def build_search_index():
+    # 在后台线程构建，会话很多时不阻塞服务启动；构建完成前检索只能命中新写入的会话
+    def build():
+        try:
+            search_index.rebuild(storage_router)
+        except Exception as e:
+            print(f"检索索引构建失败: {e}")
+
+    threading.Thread(target=build, name="search-index-rebuild", daemon=True).start()
+
+# API路由
+@app.post("/upload")
+async def upload_conversation(conversation: ConversationUpload):
+    """上传对话"""
+    shard_db = storage_router.require_db(conversation.user_id)
+    
+    # 生成会话ID
+    session_id = f"SESS_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{str(uuid.uuid4())[:8]}"
+    
+    # 存储对话
+    conversation_doc = {
+        "session_id": session_id,
+        "user_id": conversation.user_id,
+        "content": conversation.content,
+        "created_at": datetime.now().isoformat(),
+        "processed": False
+    }
+    
+    try:
+        result = shard_db.conversations.insert_one(conversation_doc)
+        storage_router.assign(conversation.user_id)
+        search_index.index_document(session_id, conversation.user_id, conversation.content)
+        return {
+            "success": True,
+            "session_id": session_id,
+            "message": "对话上传成功"
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"存储失败: {str(e)}")
+
+async def run_extraction(session_id: str, user_id: str = "default_user") -> dict:
+    """提取知识并按差异更新图谱（同一会话重复提取只保留一份提取结果）"""
+    shard_db = storage_router.require_db(user_id)
+
+    # 查找对话
+    conversation = shard_db.conversations.find_one({"session_id": session_id})
+    if not conversation or conversation.get("user_id", "default_user") != user_id:
+        raise HTTPException(status_code=404, detail="对话不存在")
+
+    # 提取知识
+    extraction_result = await extractor.extract_knowledge(conversation["content"])
+    # 等待LLM期间用户可能已被迁移到其他分片，写入前重新路由
+    shard_db = storage_router.require_db(user_id)
+
+    # 保留最后一次成功写入图谱的内容，图谱按它计算差异
+    previous = shard_db.extractions.find_one({"session_id": session_id})
+    applied = previous.get("applied") if previous else None
+
+    # 存储提取结果
+    now = datetime.now().isoformat()
+    extraction_doc = {
+        "session_id": session_id,
+        "user_id": user_id,
+        "entities": extraction_result.get("entities", []),
+        "relations": extraction_result.get("relations", []),
+        "prompt_version": EXTRACTION_PROMPT_VERSION,
+        "graph_applied": False,
+        "applied": applied,
+        "created_at": previous["created_at"] if previous else now,
+        "updated_at": now
+    }
+
+    shard_db.extractions.replace_one({"session_id": session_id}, extraction_doc, upsert=True)
+
+    # 更新对话状态
+    shard_db.conversations.update_one(
+        {"session_id": session_id},
+        {"$set": {"processed": True}}
+    )
+
+    # 构建知识图谱
+    try:
+        graph_builder.build_user_knowledge_graph(session_id, user_id)
+    except Exception as e:
+        print(f"图谱构建失败: {e}")
+
+    # 更新检索索引（加入实体名称）
+    search_index.index_document(
+        session_id, user_id, conversation["content"],
+        [entity.get("name", "") for entity in extraction_doc["entities"]]
+    )
+
+    # 移除ObjectId以避免序列化错误，已写入快照只在内部使用
+    extraction_doc.pop("_id", None)
+    extraction_doc.pop("applied", None)
+    return extraction_doc
+
+async def reprocess_outdated_extractions(limit: int = 100) -> dict:
+    """重新提取使用旧版本提示词的会话（遍历所有分片）"""
+    outdated = []
+    for shard in storage_router.shards.values():
+        if shard.db is None or len(outdated) >= limit:
+            continue
+        outdated.extend(shard.db.extractions.find(
+            {"prompt_version": {"$ne": EXTRACTION_PROMPT_VERSION}},
+            {"session_id": 1, "user_id": 1}
+        ).limit(limit - len(outdated)))
+
+    reprocessed = []
+    failed = []
+    for doc in outdated:
+        try:
+            await run_extraction(doc["session_id"], doc.get("user_id", "default_user"))
+            reprocessed.append(doc["session_id"])
+        except Exception as e:
+            print(f"重新提取失败 {doc['session_id']}: {e}")
+            failed.append({"session_id": doc["session_id"], "error": str(e)})
+
+    return {
+        "prompt_version": EXTRACTION_PROMPT_VERSION,
+        "reprocessed": reprocessed,
+        "failed": failed
+    }
+
+@app.post("/extract/reprocess")
+async def reprocess_extractions(limit: int = 100):
+    """批量重新提取旧版本提示词生成的结果"""
+    try:
+        result = await reprocess_outdated_extractions(limit)
+        return {
+            "success": True,
+            **result
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"批量重新提取失败: {str(e)}")
+
+@app.post("/extract/{session_id}")
+async def extract_knowledge(session_id: str, user_id: str = "default_user"):
+    """提取知识"""
+    try:
+        extraction_doc = await run_extraction(session_id, user_id)
+        
+        return {
+            "success": True,
+            "session_id": session_id,
+            "extraction": extraction_doc
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"知识提取失败: {str(e)}")
+
+@app.get("/result/{session_id}")
+async def get_result(session_id: str, user_id: str = "default_user"):
+    """获取提取结果"""
+    shard_db = storage_router.require_db(user_id)
+    
+    # 查找提取结果
+    result = shard_db.extractions.find_one({"session_id": session_id})
+    if not result or result.get("user_id", "default_user") != user_id:
+        raise HTTPException(status_code=404, detail="提取结果不存在")
+    
+    # 移除ObjectId以避免序列化错误
+    result.pop("_id", None)
+    
+    return {
+        "success": True,
+        "session_id": session_id,
+        "entities": result["entities"],
+        "relations": result["relations"],
+        "created_at": result["created_at"]
+    }
+
+@app.get("/search")
+async def search_conversations(q: str, user_id: str = None, limit: int = 20, offset: int = 0):
+    """全文检索对话内容和提取实体"""
+    limit = max(1, min(limit, 100))
+    offset = max(0, offset)
+
+    try:
+        result = await run_in_threadpool(search_index.search, q, user_id, limit, offset)
+
+        # 按用户所在分片批量读取对话内容
+        sessions_by_shard = {}
+        for session_id, hit_user_id, _ in result["hits"]:
+            shard = storage_router.shard_for(hit_user_id)
+            sessions_by_shard.setdefault(shard.name, (shard, []))[1].append(session_id)
+        conversations = {}
+        for shard, session_ids in sessions_by_shard.values():
+            if shard.db is None:
+                continue
+            for doc in shard.db.conversations.find(
+                {"session_id": {"$in": session_ids}},
+                {"_id": 0, "session_id": 1, "content": 1, "created_at": 1}
+            ):
+                conversations[doc["session_id"]] = doc
+
+        hits = []
+        for session_id, hit_user_id, score in result["hits"]:
+            doc = conversations.get(session_id, {})
+            hits.append({
+                "session_id": session_id,
+                "user_id": hit_user_id,
+                "score": round(score, 4),
+                "snippet": doc.get("content", "")[:200],
+                "created_at": doc.get("created_at")
+            })
+
+        return {
+            "success": True,
+            "query": q,
+            "total": result["total"],
+            "index_building": search_index.pending is not None,
+            "offset": offset,
+            "limit": limit,
+            "hits": hits
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"检索失败: {str(e)}")
+
+@app.get("/graph/{user_id}")
+async def get_knowledge_graph(user_id: str = "default_user", stream: bool = False):
+    """获取用户知识图谱（stream=true 时流式输出，适用于大图谱）"""
+    if stream:
+        return StreamingResponse(graph_builder.stream_user_knowledge_graph(user_id), media_type="application/json")
+
+    try:
+        graph_data = graph_builder.get_user_knowledge_graph(user_id)
+        return {
+            "success": True,
+            "user_id": user_id,
+            "graph": graph_data
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取图谱失败: {str(e)}")
+
+@app.post("/graph/build/{session_id}")
+async def build_knowledge_graph(session_id: str, user_id: str = "default_user"):
+    """手动构建知识图谱"""
+    try:
+        graph_builder.build_user_knowledge_graph(session_id, user_id, full=True)
+        return {
+            "success": True,
+            "session_id": session_id,
+            "user_id": user_id,
+            "message": "图谱构建成功"
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"图谱构建失败: {str(e)}")
+
+@app.post("/graph/rollback/{session_id}")
+async def rollback_knowledge_graph(session_id: str, user_id: str = "default_user"):
+    """回滚某个会话对知识图谱的全部贡献"""
+    try:
+        deleted = graph_builder.rollback_session(session_id, user_id)
+        return {
+            "success": True,
+            "session_id": session_id,
+            "deleted": deleted,
+            "message": "图谱回滚成功"
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"图谱回滚失败: {str(e)}")
+
+@app.websocket("/ws/graph/{user_id}")
+async def graph_updates(websocket: WebSocket, user_id: str):
+    """推送用户图谱的增量更新"""
+    await websocket.accept()
+    queue = graph_update_bus.subscribe(user_id)
+    if queue is None:
+        # 超过每个进程的连接上限
+        await websocket.close(code=1013, reason="连接数已达上限")
+        return
+
+    async def forward():
+        try:
+            while True:
+                await websocket.send_text(await queue.get())
+        except Exception as e:
+            print(f"图谱推送中断: {e}")
+
+    async def wait_disconnect():
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+
+    tasks = [asyncio.create_task(forward()), asyncio.create_task(wait_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        graph_update_bus.unsubscribe(user_id, queue)
+
+# 第三阶段：智能健康问答API
+
+@app.get("/health/profile/{user_id}")
+async def generate_health_profile(user_id: str = "default_user", refresh: bool = False):
+    """获取个人健康档案
+
+    直接返回预生成的档案；档案过期时先返回旧档案并在后台重新生成（freshness 字段标明是否最新）。
+    尚无档案或 refresh=true 时同步生成。
+    """
+    try:
+        profile_doc = health_profile_service.latest_profile(user_id)
+        if profile_doc is None or refresh:
+            try:
+                profile_doc = await health_profile_service.regenerate(user_id, force=refresh)
+            except LLMUnavailableError as e:
+                # AI服务不可用且没有已生成的档案：降级返回原始健康数据
+                health_data = health_analysis_service.get_user_health_summary(user_id)
+                return {
+                    "success": False,
+                    "degraded": True,
+                    "user_id": user_id,
+                    "health_data": HealthProfileService._storable_health_data(health_data),
+                    "profile": None,
+                    "error": str(e),
+                    "message": "AI服务暂时不可用，已返回原始健康数据",
+                    "timestamp": datetime.now().isoformat()
+                }
+            except RuntimeError as e:
+                return {
+                    "success": False,
+                    "user_id": user_id,
+                    "error": str(e),
+                    "timestamp": datetime.now().isoformat()
+                }
+
+        if profile_doc is None:
             return {
                 "success": False,
                 "message": "用户暂无健康数据，请先上传对话记录",
                 "user_id": user_id
             }
-        
-        # 格式化数据
-        health_data_text = health_analysis_service.format_health_data_for_llm(health_data)
-        print(f"格式化后的健康数据: {health_data_text[:200]}...")
-        
-        # 生成健康档案
-        result = await health_analysis_llm.generate_health_profile(health_data_text)
-        print(f"LLM调用结果: {result}")
+
+        freshness = health_profile_service.freshness(user_id, profile_doc)
+        if freshness["status"] == "stale":
+            health_profile_service.schedule(user_id, 0)
+            freshness["status"] = "regenerating"
         
         return {
-            "success": result["success"],
+            "success": True,
             "user_id": user_id,
-            "health_data": health_data,
-            "profile": result.get("profile"),
-            "error": result.get("error"),
-            "timestamp": result["timestamp"]
+            "health_data": profile_doc["health_data"],
+            "profile": profile_doc["profile"],
+            "error": None,
+            "timestamp": profile_doc["generated_at"],
+            "freshness": freshness
         }
         
     except Exception as e:
@@ -764,11 +2831,33 @@ async def ask_health_question(user_id: str, question_data: HealthQuestion):
                 "question": question
             }
         
-        # 格式化数据
-        health_data_text = health_analysis_service.format_health_data_for_llm(health_data)
+        # 格式化数据（近期变化详细，更早历史精简）
+        health_data_text = health_analysis_service.build_llm_context(user_id, health_data)
+        if ANALYTICS_ENRICH_PROMPTS:
+            try:
+                names = [item["name"] for item in health_data["symptoms"] + health_data["diseases"]]
+                health_data_text += "\n" + cooccurrence_analytics.format_related_for_llm(names)
+            except Exception as e:
+                print(f"获取人群关联数据失败: {e}")
         
         # 回答健康问题
         result = await health_analysis_llm.answer_health_question(question, health_data_text)
+        if result.get("degraded"):
+            # AI服务不可用：降级返回已生成的健康档案和原始健康数据
+            cached = health_profile_service.latest_profile(user_id)
+            return {
+                "success": False,
+                "degraded": True,
+                "user_id": user_id,
+                "question": question,
+                "answer": None,
+                "error": result["error"],
+                "message": "AI服务暂时不可用，已返回已有健康档案和原始健康数据",
+                "cached_profile": cached["profile"] if cached else None,
+                "cached_profile_generated_at": cached["generated_at"] if cached else None,
+                "health_data": HealthProfileService._storable_health_data(health_data),
+                "timestamp": result["timestamp"]
+            }
         
         return {
             "success": result["success"],
@@ -811,6 +2900,142 @@ async def get_health_summary(user_id: str = "default_user"):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取健康摘要失败: {str(e)}")
 
+@app.get("/health/timeline/{user_id}")
+async def get_health_timeline(user_id: str, start: str = None, end: str = None,
+                              days: int = None, limit: int = 50, cursor: str = None):
+    """按时间范围查询健康时间线（游标分页）"""
+    try:
+        start_time = datetime.fromisoformat(start) if start else None
+        end_time = datetime.fromisoformat(end) if end else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="时间格式错误，请使用ISO格式")
+    if days and not start_time:
+        start_time = datetime.now() - timedelta(days=days)
+    limit = max(1, min(limit, 500))
+
+    try:
+        page = health_timeline.query_events(user_id, start_time, end_time, limit, cursor)
+        return {
+            "success": True,
+            "user_id": user_id,
+            "start": start_time.isoformat() if start_time else None,
+            "end": end_time.isoformat() if end_time else None,
+            **page
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取健康时间线失败: {str(e)}")
+
+# 健康记录导出/导入API
+
+@app.get("/export/{user_id}")
+async def export_health_record(user_id: str):
+    """流式导出用户完整健康记录（gzip压缩的分块NDJSON）"""
+    shard = storage_router.shard_for(user_id)
+    if shard.db is None or not shard.driver:
+        raise HTTPException(status_code=500, detail=f"分片 {shard.name} 连接失败")
+    filename = f"health_record_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson.gz"
+    return StreamingResponse(
+        health_record_archive.export_gzip(user_id),
+        media_type="application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.post("/import")
+async def import_health_record(file: UploadFile = File(...)):
+    """导入健康记录归档（重新上传同一归档会从中断处继续）"""
+    with tempfile.NamedTemporaryFile(suffix=".ndjson.gz", delete=False) as temp:
+        while chunk := await file.read(1024 * 1024):
+            temp.write(chunk)
+        path = temp.name
+
+    try:
+        result = await run_in_threadpool(health_record_archive.import_file, path)
+        return {"success": True, **result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"导入失败: {str(e)}")
+    finally:
+        os.remove(path)
+
+# 跨用户分析API
+
+@app.get("/analytics/related/{entity}")
+async def get_related_entities(entity: str, limit: int = 10):
+    """查询与实体共现的症状/疾病/药物（按提升度排序）"""
+    try:
+        results = cooccurrence_analytics.related(entity, max(1, min(limit, ANALYTICS_TOP_K)))
+        return {
+            "success": True,
+            "entity": entity,
+            "results": results
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"查询关联实体失败: {str(e)}")
+
+@app.post("/analytics/run")
+def run_cooccurrence_analytics(full: bool = False):
+    """运行共现分析任务（默认增量，耗时操作，在线程池中执行）"""
+    try:
+        return {"success": True, **cooccurrence_analytics.run(full)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"共现分析失败: {str(e)}")
+
+# LLM服务监控API
+
+@app.get("/metrics/llm")
+async def get_llm_metrics():
+    """LLM调用熔断器状态和计数"""
+    return {
+        "breaker": llm_breaker.snapshot(),
+        "config": {
+            "timeout_seconds": LLM_TIMEOUT_SECONDS,
+            "default_deadline_seconds": LLM_DEFAULT_DEADLINE_SECONDS,
+            "max_retries": LLM_MAX_RETRIES,
+            "failure_threshold": llm_breaker.failure_threshold,
+            "slow_call_seconds": llm_breaker.slow_call_seconds,
+            "reset_seconds": llm_breaker.reset_seconds
+        },
+        "timestamp": datetime.now().isoformat()
+    }
+
+# 存储分片管理API
+
+@app.get("/admin/shards")
+async def list_shards():
+    """查看存储分片状态"""
+    return {
+        "success": True,
+        "shards": [
+            {"name": shard.name, "mongodb": shard.db is not None, "neo4j": shard.driver is not None}
+            for shard in storage_router.shards.values()
+        ]
+    }
+
+@app.post("/admin/shards/migrate/{user_id}")
+def migrate_user_shard(user_id: str, target: str):
+    """在线迁移用户数据到目标分片（耗时操作，在线程池中执行）"""
+    try:
+        return {"success": True, **shard_migrator.migrate_user(user_id, target)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"迁移失败: {str(e)}")
+
+@app.post("/admin/shards/rebalance")
+def rebalance_shards(apply: bool = False):
+    """按一致性哈希环重新平衡用户（apply=false 时只返回迁移计划）"""
+    try:
+        return {"success": True, **shard_migrator.rebalance(apply)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"重新平衡失败: {str(e)}")
+
 # 静态文件服务
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -833,6 +3058,30 @@ async def result_page():
         return HTMLResponse(content=f.read())
 
 if __name__ == "__main__":
-    import uvicorn
-    port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "reprocess":
+        # 批量重新提取旧版本提示词生成的结果: python main.py reprocess [limit]
+        limit = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        print(asyncio.run(reprocess_outdated_extractions(limit)))
+    elif len(sys.argv) > 3 and sys.argv[1] == "export":
+        # 导出用户健康记录: python main.py export <user_id> <文件路径>
+        print(health_record_archive.export_to_file(sys.argv[2], sys.argv[3]))
+    elif len(sys.argv) > 2 and sys.argv[1] == "import":
+        # 导入健康记录（可多次执行以断点续传）: python main.py import <文件路径> [<文件路径> ...]
+        for path in sys.argv[2:]:
+            print(health_record_archive.import_file(path))
+    elif len(sys.argv) > 1 and sys.argv[1] == "analytics":
+        # 共现分析任务（可由定时任务调用）: python main.py analytics [--full]
+        print(cooccurrence_analytics.run(full="--full" in sys.argv))
+    elif len(sys.argv) > 2 and sys.argv[1] == "shards":
+        # 分片管理: python main.py shards sync | rebalance [--apply] | migrate <user_id> <target>
+        if sys.argv[2] == "sync":
+            print(f"新登记用户: {shard_migrator.sync_directory()}")
+        elif sys.argv[2] == "rebalance":
+            print(shard_migrator.rebalance(apply="--apply" in sys.argv))
+        elif sys.argv[2] == "migrate" and len(sys.argv) > 4:
+            print(shard_migrator.migrate_user(sys.argv[3], sys.argv[4]))
+    else:
+        import uvicorn
+        port = int(os.getenv("PORT", 8000))
+        uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""LLM调用容错测试：启动一个可注入故障的本地模拟DeepSeek服务，验证截止时间、重试和熔断
+
+不需要DeepSeek API Key。用法：
+    python test_llm_resilience.py
+"""
+import asyncio
+import socket
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# 模拟服务的故障模式：ok / error（返回500）/ slow（延迟后返回）/ flaky（前 fail_count 次返回500）
+fault = {"mode": "ok", "delay": 0.0, "fail_count": 0, "hits": 0}
+mock_app = FastAPI()
+
+@mock_app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    fault["hits"] += 1
+    body = await request.json()
+    if fault["mode"] == "error" or (fault["mode"] == "flaky" and fault["hits"] <= fault["fail_count"]):
+        return JSONResponse({"error": "injected failure"}, status_code=500)
+    if fault["mode"] == "slow":
+        await asyncio.sleep(fault["delay"])
+    content = f"mock reply to {len(body['messages'])} messages"
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+def set_fault(mode: str, **options):
+    fault.update({"mode": mode, "delay": 0.0, "fail_count": 0, "hits": 0, **options})
+
+def start_mock_server() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(mock_app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return port
+
+async def run_checks(port: int):
+    import main
+    from main import CircuitBreaker, DeepSeekClient, HealthProfileService, LLMUnavailableError, request_deadline
+
+    default_deadline = main.LLM_DEFAULT_DEADLINE_SECONDS
+
+    messages = [{"role": "user", "content": "测试"}]
+    breaker = CircuitBreaker(failure_threshold=3, slow_call_seconds=1.0, reset_seconds=1.0)
+    client = DeepSeekClient(f"http://127.0.0.1:{port}", "test-key", breaker)
+
+    set_fault("ok")
+    assert await client.chat_completion(messages, temperature=0.1)
+    assert breaker.state == "closed"
+    print("正常调用: 通过")
+
+    set_fault("flaky", fail_count=2)
+    assert await client.chat_completion(messages, temperature=0.1)
+    assert fault["hits"] == 3 and breaker.state == "closed"
+    print("失败后重试成功: 通过")
+
+    set_fault("error")
+    try:
+        await client.chat_completion(messages, temperature=0.1)
+        raise AssertionError("应当失败")
+    except LLMUnavailableError:
+        pass
+    assert breaker.state == "open"
+    hits = fault["hits"]
+    started = time.monotonic()
+    try:
+        await client.chat_completion(messages, temperature=0.1)
+        raise AssertionError("应当失败")
+    except LLMUnavailableError:
+        pass
+    assert fault["hits"] == hits and time.monotonic() - started < 0.1
+    print(f"连续失败后熔断并快速失败: 通过 {breaker.snapshot()}")
+
+    # 探测请求被取消（如客户端断开）时释放探测名额并重新熔断，之后仍能恢复
+    set_fault("slow", delay=2.0)
+    await asyncio.sleep(breaker.reset_seconds)
+    probe = asyncio.create_task(client.chat_completion(messages, temperature=0.1))
+    await asyncio.sleep(0.2)
+    assert breaker.state == "half_open" and breaker.probe_in_flight
+    probe.cancel()
+    try:
+        await probe
+    except asyncio.CancelledError:
+        pass
+    assert breaker.state == "open" and not breaker.probe_in_flight
+    print("探测请求被取消后重新熔断: 通过")
+
+    set_fault("ok")
+    await asyncio.sleep(breaker.reset_seconds)
+    assert await client.chat_completion(messages, temperature=0.1)
+    assert breaker.state == "closed"
+    print("熔断到期后探测请求成功并恢复: 通过")
+
+    set_fault("slow", delay=2.0)
+    token = request_deadline.set(time.monotonic() + 0.5)
+    started = time.monotonic()
+    try:
+        await client.chat_completion(messages, temperature=0.1)
+        raise AssertionError("应当超时")
+    except LLMUnavailableError:
+        pass
+    finally:
+        request_deadline.reset(token)
+    elapsed = time.monotonic() - started
+    assert elapsed < 1.0, elapsed
+    print(f"请求截止时间限制调用耗时: 通过（{elapsed:.2f}s）")
+
+    # 未传截止时间时使用默认总时间上限，重试不会超过它
+    main.LLM_DEFAULT_DEADLINE_SECONDS = 0.8
+    started = time.monotonic()
+    try:
+        await client.chat_completion(messages, temperature=0.1)
+        raise AssertionError("应当超时")
+    except LLMUnavailableError:
+        pass
+    finally:
+        main.LLM_DEFAULT_DEADLINE_SECONDS = default_deadline
+    elapsed = time.monotonic() - started
+    assert elapsed < 1.3, elapsed
+    print(f"默认截止时间限制调用和重试的总耗时: 通过（{elapsed:.2f}s）")
+
+    # 请求中安排的后台档案生成不继承该请求的截止时间（请求结束后截止时间早已过去）
+    class ProfileService(HealthProfileService):
+        async def regenerate(self, user_id: str, force: bool = False):
+            try:
+                generated.set_result(await client.chat_completion(messages, temperature=0.1))
+            except Exception as e:
+                generated.set_exception(e)
+
+    set_fault("ok")
+    generated = asyncio.get_running_loop().create_future()
+    service = ProfileService(main.storage_router, debounce_seconds=0)
+    service.loop = asyncio.get_running_loop()
+    token = request_deadline.set(time.monotonic() - 1)
+    try:
+        service.schedule("user_deadline")
+    finally:
+        request_deadline.reset(token)
+    assert await asyncio.wait_for(generated, 5)
+    print("后台档案生成不继承请求截止时间: 通过")
+
+    assert await client.chat_completion(messages, temperature=0.1)
+    set_fault("slow", delay=1.2)
+    for _ in range(breaker.failure_threshold):
+        assert await client.chat_completion(messages, temperature=0.1)
+    assert breaker.state == "open" and breaker.stats["slow_calls"] == breaker.failure_threshold
+    print("连续慢响应后熔断: 通过")
+
+if __name__ == "__main__":
+    port = start_mock_server()
+    asyncio.run(run_checks(port))
+    print("全部通过")
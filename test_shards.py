@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""存储分片测试：用内存中的MongoDB（mongomock）和空的Neo4j替身验证哈希环、分片目录和用户迁移
+
+不需要数据库，需要开发依赖（pip install -r requirements-dev.txt）。用法：
+    python test_shards.py
+"""
+import mongomock
+
+class FakeResult:
+    def __iter__(self):
+        return iter([])
+
+    def single(self):
+        return None
+
+    def consume(self):
+        return None
+
+class FakeSession:
+    """空图谱：读取不到用户节点，写入直接忽略"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def run(self, *args, **kwargs):
+        return FakeResult()
+
+    def execute_write(self, func, *args):
+        return func(self, *args)
+
+class FakeDriver:
+    def session(self):
+        return FakeSession()
+
+def make_shards(names: list) -> list:
+    from main import StorageShard
+
+    client = mongomock.MongoClient()
+    return [StorageShard(name, client[f"health_resume_{name}"], FakeDriver()) for name in names]
+
+def check_ring(users: list):
+    from main import ShardRouter
+
+    two = ShardRouter(make_shards(["s1", "s2"]), directory_ttl=0)
+    three = ShardRouter(make_shards(["s1", "s2", "s3"]), directory_ttl=0)
+    counts = {}
+    for user_id in users:
+        counts[two.ring_shard(user_id).name] = counts.get(two.ring_shard(user_id).name, 0) + 1
+    assert all(count > len(users) * 0.3 for count in counts.values()), counts
+
+    moved = [user_id for user_id in users if two.ring_shard(user_id).name != three.ring_shard(user_id).name]
+    # 增加一个分片时只有约1/3的用户在哈希环上改变位置，且都移动到新分片
+    assert len(moved) < len(users) * 0.45, len(moved)
+    assert all(three.ring_shard(user_id).name == "s3" for user_id in moved)
+    print(f"哈希环分布 {counts}，增加分片后移动 {len(moved)}/{len(users)}: 通过")
+
+def check_directory_pinning(users: list):
+    from main import ShardRouter, ShardMigrator
+
+    shards = make_shards(["s1", "s2", "s3"])
+    two = ShardRouter(shards[:2], directory_ttl=0)
+    assigned = {user_id: two.assign(user_id).name for user_id in users}
+
+    three = ShardRouter(shards, directory_ttl=0)
+    assert all(three.shard_for(user_id).name == assigned[user_id] for user_id in users)
+    plan = ShardMigrator(three).rebalance(apply=False)["plan"]
+    assert plan and all(move["target"] == "s3" for move in plan)
+    print(f"增加分片后已分配用户仍按目录路由，重新平衡计划 {len(plan)} 个用户: 通过")
+
+def seed_user(db, user_id: str, sessions: int):
+    for index in range(sessions):
+        session_id = f"SESS_{user_id}_{index}"
+        db.conversations.insert_one({"session_id": session_id, "user_id": user_id, "content": "头痛"})
+        db.extractions.insert_one({"session_id": session_id, "user_id": user_id, "entities": [], "relations": []})
+    db.profile_state.insert_one({"user_id": user_id, "graph_version": sessions})
+
+def check_migration():
+    from main import ShardRouter, ShardMigrator, HTTPException
+
+    shards = make_shards(["s1", "s2"])
+    router = ShardRouter(shards, directory_ttl=0)
+    user_id = "user_migrate"
+    source = router.assign(user_id)
+    target = next(shard for shard in shards if shard.name != source.name)
+    seed_user(source.db, user_id, 3)
+
+    migrator = ShardMigrator(router)
+    migrator.CATCH_UP_SETTLE_SECONDS = 0
+    copy_user = migrator._copy_user
+    calls = {"count": 0}
+
+    # 第一次追平时模拟路由切换前开始的请求写入源分片
+    def copy_with_late_write(src, dst, uid):
+        calls["count"] += 1
+        result = copy_user(src, dst, uid)
+        if calls["count"] == 2:
+            src.db.conversations.insert_one({"session_id": "SESS_late", "user_id": uid, "content": "迟到的写入"})
+        return result
+
+    migrator._copy_user = copy_with_late_write
+    result = migrator.migrate_user(user_id, target.name, wait_seconds=0)
+    assert result["moved"] and router.shard_for(user_id).name == target.name
+    assert target.db.conversations.count_documents({"user_id": user_id}) == 4
+    assert source.db.conversations.count_documents({"user_id": user_id}) == 0
+    # 图谱版本随档案一起迁移，迁移完成后再加1，已复制的档案不会被误判为最新
+    assert target.db.profile_state.find_one({"user_id": user_id})["graph_version"] == 4
+    assert "migrating_from" not in router.directory.find_one({"user_id": user_id})
+    print("迁移并追平迁移期间的写入: 通过")
+
+    # 源分片持续写入时不删除源数据，之后重新执行迁移从原来的源分片继续
+    other = "user_busy"
+    router.set_shard(other, source.name)
+    seed_user(source.db, other, 2)
+
+    def copy_with_writes(src, dst, uid):
+        result = copy_user(src, dst, uid)
+        src.db.conversations.insert_one({"session_id": f"SESS_busy_{calls['count']}", "user_id": uid, "content": ""})
+        calls["count"] += 1
+        return result
+
+    migrator._copy_user = copy_with_writes
+    try:
+        migrator.migrate_user(other, target.name, wait_seconds=0)
+        raise AssertionError("应当失败")
+    except HTTPException as e:
+        assert e.status_code == 409
+    pending = source.db.conversations.count_documents({"user_id": other})
+    assert pending > 0
+
+    migrator._copy_user = copy_user
+    result = migrator.migrate_user(other, target.name, wait_seconds=0)
+    assert result["moved"] and result["source"] == source.name
+    assert source.db.conversations.count_documents({"user_id": other}) == 0
+    assert target.db.conversations.count_documents({"user_id": other}) == pending
+    print("源分片持续写入时保留源数据，重新执行后完成迁移: 通过")
+
+if __name__ == "__main__":
+    users = [f"user_{index}" for index in range(3000)]
+    check_ring(users)
+    check_directory_pinning(users[:300])
+    check_migration()
+    print("全部通过")